@@ -0,0 +1,122 @@
+#
+# Tree Cache
+# ==========
+#
+# %%LICENSE%%
+#
+import os
+import cPickle as pickle
+from dep import opts
+from dep.helpers import *
+
+class TreeCache:
+    # Resolved dependency tree stored under the root git directory. It is only valid
+    # while every .depconfig it was built from has the same mtime, size and inode, and
+    # was last changed strictly before the cache was written. A change within the same
+    # timestamp tick as the cache itself could otherwise go unnoticed.
+    VERSION = 2
+
+    def __init__(self, git_dir):
+        self.path = os.path.join(git_dir, "dep-tree-cache")
+
+    def __str__(self):
+        return "TreeCache '{}'".format(self.path)
+
+    @staticmethod
+    def fingerprint(path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return (st.st_mtime, st.st_size, st.st_ino)
+
+    def load(self, root_path):
+        try:
+            with open(self.path, 'rb') as handle:
+                cache_mtime = os.fstat(handle.fileno()).st_mtime
+                data = pickle.load(handle)
+        except (IOError, EOFError, pickle.UnpicklingError, ValueError, TypeError):
+            return None
+        if data.get('version') != TreeCache.VERSION or data.get('root') != root_path:
+            return None
+        for path, fingerprint in data['configs']:
+            if TreeCache.fingerprint(path) != fingerprint:
+                debug("{} is out of date, '{}' changed", self, path)
+                return None
+            if fingerprint is not None and fingerprint[0] >= cache_mtime:
+                debug("{} is not trusted, '{}' changed as it was written", self, path)
+                return None
+        debug("Using {}", self)
+        return data
+
+    def save(self, root_path, config_paths, data):
+        if opts.args.dry_run:
+            return
+        data = dict(data, version=TreeCache.VERSION, root=root_path,
+                    configs=[(path, TreeCache.fingerprint(path)) for path in config_paths])
+        tmp_path = "{}.{}.tmp".format(self.path, os.getpid())
+        try:
+            with open(tmp_path, 'wb') as handle:
+                pickle.dump(data, handle, pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp_path, self.path)
+        except (IOError, OSError), e:
+            # The cache is only an optimisation.
+            debug("Cannot write {}: {}", self, e)
+
+class RefSnapshot:
+    # Branch and commit of each repository as last recorded, stored under the root git
+    # directory. An entry is only valid while the files git keeps that state in, such
+    # as HEAD and the branch ref, have the same mtime, size and inode, and were last
+    # changed strictly before the snapshot was written, as for TreeCache.
+    VERSION = 1
+
+    def __init__(self, git_dir):
+        self.path = os.path.join(git_dir, "dep-ref-snapshot")
+        self.entries = {}
+        self.changed = False
+
+    def __str__(self):
+        return "RefSnapshot '{}'".format(self.path)
+
+    def load(self):
+        try:
+            with open(self.path, 'rb') as handle:
+                snapshot_mtime = os.fstat(handle.fileno()).st_mtime
+                data = pickle.load(handle)
+        except (IOError, EOFError, pickle.UnpicklingError, ValueError, TypeError):
+            return
+        if data.get('version') != RefSnapshot.VERSION:
+            return
+        for work_dir, entry in data['entries'].items():
+            fingerprints = entry[2]
+            if all(fingerprint is None or fingerprint[0] < snapshot_mtime for path, fingerprint in fingerprints):
+                self.entries[work_dir] = entry
+
+    def lookup(self, work_dir):
+        entry = self.entries.get(work_dir)
+        if entry is None:
+            return None
+        (branch, commit, fingerprints) = entry
+        for path, fingerprint in fingerprints:
+            if TreeCache.fingerprint(path) != fingerprint:
+                return None
+        return (branch, commit)
+
+    def update(self, work_dir, branch, commit, paths):
+        fingerprints = [(path, TreeCache.fingerprint(path)) for path in paths]
+        self.entries[work_dir] = (branch, commit, fingerprints)
+        self.changed = True
+
+    def save(self):
+        if opts.args.dry_run or not self.changed:
+            return
+        tmp_path = "{}.{}.tmp".format(self.path, os.getpid())
+        try:
+            with open(tmp_path, 'wb') as handle:
+                pickle.dump({'version': RefSnapshot.VERSION, 'entries': self.entries}, handle,
+                            pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp_path, self.path)
+            self.changed = False
+        except (IOError, OSError), e:
+            # The snapshot is only an optimisation.
+            debug("Cannot write {}: {}", self, e)
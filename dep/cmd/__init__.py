@@ -4,6 +4,33 @@
 #
 # %%LICENSE%%
 #
-__all__ = ["add", "branch", "checkout", "clone", "commit", "config", "diff", "fetch", "foreach",
-           "help", "init", "list", "merge", "pull", "push", "record", "refresh", "status", "tag",
-           "worktree"]
+from dep import opts
+
+# Commands listed in help order, each module is only imported when its command
+# is used. A command module adds its own subparser with the description and
+# arguments, the help line here is shown in the general help.
+commands = [
+    ("add",      "Add a new dependency to root dependency"),
+    ("branch",   "Branch all dependencies to new branch"),
+    ("checkout", "Checkout current dependency, refresh children"),
+    ("clone",    "Clone given URL then refresh children"),
+    ("commit",   "Commit changes for each dependency"),
+    ("config",   "Dependency configuration"),
+    ("diff",     "Diff changes for each dependency"),
+    ("fetch",    "Fetch changes for each dependency"),
+    ("foreach",  "Run a shell command for each dependency"),
+    ("help",     "Show general or specific command help"),
+    ("init",     "Initialise dependency system for this component"),
+    ("list",     "List dependencies"),
+    ("merge",    "Merge all dependencies with given branch"),
+    ("pull",     "Pull changes for each dependency"),
+    ("push",     "Push changes for each dependency"),
+    ("record",   "Record dependencies from current source repository state"),
+    ("refresh",  "Refresh dependencies from their source repositories"),
+    ("status",   "Show dependency status for all source repositories"),
+    ("tag",      "Tag each dependency"),
+    ("worktree", "Create a worktree for all dependencies")
+]
+
+for (name, help) in commands:
+    opts.subparsers.add_command(name, "dep.cmd.{}".format(name), help)
@@ -12,7 +12,6 @@ def command_add(args):
     tree.add_dependency(args.url, args.branch)
 
 parser_add = opts.subparsers.add_parser("add",
-                                        help="Add a new dependency to root dependency",
                                         description="Add a new dependency to root dependency.")
 add_local_arguments(parser_add)
 parser_add.add_argument("url",
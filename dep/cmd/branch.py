@@ -12,9 +12,11 @@ def command_branch(args):
     tree.branch_dependency_tree(args.name, args.startpoint, vars(args))
     
 parser_branch = opts.subparsers.add_parser("branch",
-                                      help="Branch all dependencies to new branch",
                                       description="Branch all dependencies to new branch. Each dependency gets a new commit.")
+add_jobs_arguments(parser_branch)
 add_list_arguments(parser_branch)
+parser_branch.add_argument("--refs-only", dest="refs_only", action="store_true",
+                           help="Only create the branch in each dependency, without checking it out or committing")
 parser_branch.add_argument("name",
                            help="Name of branch to create, must not exist")
 parser_branch.add_argument("startpoint", nargs="?",
@@ -12,8 +12,8 @@ def command_checkout(args):
     tree.checkout_dependency_tree(args.name, args.startpoint, vars(args))
 
 parser_checkout = opts.subparsers.add_parser("checkout",
-                                             help="Checkout current dependency, refresh children",
                                              description="Checkout current dependency, refresh children. Shortcut for \"git checkout\" followed by \"dep refresh\".")
+add_jobs_arguments(parser_checkout)
 add_local_arguments(parser_checkout)
 parser_checkout.add_argument("name",
                              help="Name of branch to checkout, must exist")
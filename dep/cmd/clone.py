@@ -11,8 +11,8 @@ def command_clone(args):
     dependency.Tree.clone_dependency_tree(args.url, args.directory, vars(args))
 
 parser_clone = opts.subparsers.add_parser("clone",
-                                          help="Clone given URL then refresh children",
                                           description="Clone given URL then refresh children. Shortcut form for \"git clone\" followed by \"dep checkout\".")
+add_jobs_arguments(parser_clone)
 add_local_arguments(parser_clone)
 parser_clone.add_argument("-b", "--branch", dest="clone_branch",
                           help="Branch to checkout after clone, default is master.")
@@ -4,7 +4,7 @@
 #
 # %%LICENSE%%
 #
-from dep import *
+from dep import opts
 from dep.helpers import *
 
 def command_config(args):
@@ -20,7 +20,6 @@ def command_config(args):
         print path
 
 parser_config = opts.subparsers.add_parser("config",
-                                           help="Dependency configuration",
                                            description="Dependency configuration.")
 parser_config.add_argument("--work-dir", action="store_true",
                            help="Show the working directory of this dependency and exit")
@@ -9,11 +9,12 @@ from dep.helpers import *
 
 def command_fetch(args):
     tree = dependency.Tree()
-    tree.foreach_dependency(["git", "fetch"] + opts.rest_args, vars(args))
+    tree.fetch_dependency_tree(opts.rest_args, vars(args))
 
 parser_fetch = opts.subparsers.add_parser("fetch",
-                                      help="Fetch changes for each dependency",
-                                      description="Fetch changes for each dependency")
+                                      description="Fetch changes for each dependency once, then show time taken and size fetched for each.")
+add_jobs_arguments(parser_fetch)
+add_jobs_per_host_arguments(parser_fetch)
 add_list_arguments(parser_fetch)
 parser_fetch.set_defaults(func=command_fetch)
 opts.allow_rest.append("fetch")
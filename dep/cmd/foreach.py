@@ -12,7 +12,6 @@ def command_foreach(args):
     tree.foreach_dependency(opts.rest_args, vars(args))
 
 parser_foreach = opts.subparsers.add_parser("foreach",
-                                            help="Run a shell command for each dependency",
                                             description="Run a shell command for each dependency.")
 parser_foreach.add_argument("--record", dest="foreach_record", action="store_true",
                            help="Run record operation after each command run")
@@ -22,6 +21,11 @@ parser_foreach.add_argument("--only-modified", dest="foreach_only_modified", act
                            help="Run command only on repositories with local modifications")
 parser_foreach.add_argument("-f", "--allow-failure", dest="allow_failure", action="store_true",
                            help="Continue on even if command exits with non-zero failure code")
+parser_foreach.add_argument("--order", dest="foreach_order", metavar="ORDER",
+                           choices=dependency.TreeSchedule.ORDERS, default=dependency.TreeSchedule.CHILDREN_FIRST,
+                           help="Run for dependencies before their parents (children-first, default), "
+                           "parents before their dependencies (parents-first), or in any order (unordered)")
+add_jobs_arguments(parser_foreach)
 add_list_arguments(parser_foreach)
 parser_foreach.set_defaults(func=command_foreach)
 opts.allow_rest.append("foreach")
@@ -13,6 +13,5 @@ def command_init(args):
     tree.init_dependency()
 
 parser_init = opts.subparsers.add_parser("init",
-                                         help="Initialise dependency system for this component",
                                          description="Initialise dependency system for this component.")
 parser_init.set_defaults(func=command_init)
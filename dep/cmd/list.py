@@ -12,7 +12,8 @@ def command_list(args):
     tree.list_dependency_tree(vars(args))
 
 parser_list = opts.subparsers.add_parser("list",
-                                         help="List dependencies",
                                          description="List dependencies.")
 add_list_arguments(parser_list)
+parser_list.add_argument("--at", dest="list_at", metavar="REV",
+                         help="List the dependencies recorded at REV of the root project, without checking them out")
 parser_list.set_defaults(func=command_list)
@@ -12,7 +12,6 @@ def command_merge(args):
     tree.merge_dependency_tree(args.name, vars(args))
     
 parser_merge = opts.subparsers.add_parser("merge",
-                                          help="Merge all dependencies with given branch",
                                           description="Merge all dependencies with given branch.")
 add_local_arguments(parser_merge)
 parser_merge.add_argument("name",
@@ -9,11 +9,11 @@ from dep.helpers import *
 
 def command_pull(args):
     tree = dependency.Tree()
-    tree.foreach_dependency(["git", "pull"] + opts.rest_args, vars(args))
+    tree.pull_dependency_tree(vars(args))
 
 parser_pull = opts.subparsers.add_parser("pull",
-                                      help="Pull changes for each dependency",
-                                      description="Pull changes for each dependency")
+                                      description="Fetch changes for each dependency at once, then fast-forward each to its upstream branch. Never merges or rebases, a dependency which has diverged is reported instead.")
+add_jobs_arguments(parser_pull)
+add_jobs_per_host_arguments(parser_pull)
 add_list_arguments(parser_pull)
 parser_pull.set_defaults(func=command_pull)
-opts.allow_rest.append("pull")
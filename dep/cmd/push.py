@@ -15,8 +15,8 @@ def command_push(args):
     tree.foreach_dependency(["git", "push"] + opts.rest_args, flags)
 
 parser_push = opts.subparsers.add_parser("push",
-                                      help="Push changes for each dependency",
                                       description="Push changes for each dependency")
+add_jobs_arguments(parser_push)
 add_list_arguments(parser_push)
 parser_push.set_defaults(func=command_push)
 opts.allow_rest.append("push")
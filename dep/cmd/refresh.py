@@ -12,6 +12,6 @@ def command_refresh(args):
     tree.refresh_dependency_tree()
 
 parser_refresh = opts.subparsers.add_parser("refresh",
-                                            help="Refresh dependencies from their source repositories",
                                             description="Refresh dependencies from their source repositories.")
+add_jobs_arguments(parser_refresh)
 parser_refresh.set_defaults(func=command_refresh)
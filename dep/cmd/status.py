@@ -12,7 +12,6 @@ def command_status(args):
     tree.status_dependency_tree(vars(args))
     
 parser_status = opts.subparsers.add_parser("status",
-                                           help="Show dependency status for all source repositories",
                                            description="Show dependency status for all source repositories.")
 parser_status.add_argument("-s", "--short", dest="status_short", action="store_true",
                            help="Show short status only (default)")
@@ -30,5 +29,6 @@ parser_status.add_argument("--push-clean", dest="status_push_clean", action="sto
                            help="Consider push clean (value 0) if exit status required.")
 parser_status.add_argument("--pull-clean", dest="status_pull_clean", action="store_true",
                            help="Consider pull clean (value 0) if exit status required.")
+add_jobs_arguments(parser_status)
 add_list_arguments(parser_status)
 parser_status.set_defaults(func=command_status)
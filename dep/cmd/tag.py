@@ -9,11 +9,21 @@ from dep.helpers import *
 
 def command_tag(args):
     tree = dependency.Tree()
-    tree.foreach_dependency(["git", "tag"] + opts.rest_args, vars(args))
+    if args.refs_only:
+        if len(opts.rest_args) != 1:
+            error("Tag with --refs-only needs only a tag name, not: {}", " ".join(opts.rest_args))
+        tree.tag_dependency_tree(opts.rest_args[0], vars(args))
+        return
+    flags = vars(args)
+    flags.update(foreach_order=dependency.TreeSchedule.UNORDERED)
+    tree.foreach_dependency(["git", "tag"] + opts.rest_args, flags)
 
 parser_tag = opts.subparsers.add_parser("tag",
-                                      help="Tag each dependency",
                                       description="Tag each dependency.")
+parser_tag.add_argument("--refs-only", dest="refs_only", action="store_true",
+                        help="Create a lightweight tag at HEAD of each dependency in one transaction each, "
+                        "all at once, reporting every failure at the end")
+add_jobs_arguments(parser_tag)
 add_list_arguments(parser_tag)
 parser_tag.set_defaults(func=command_tag)
 opts.allow_rest.append("tag")
@@ -7,15 +7,32 @@
 import sys
 import os
 import re
+import cStringIO
 from dep import opts
 from dep.helpers import *
 
+_section_re = re.compile(r'^\s*\[\s*([-a-zA-Z0-9]*)\s*("([^"]*)")?\s*\]\s*$')
+_var_re = re.compile(r'^\s*([-a-zA-Z0-9]*)\s*=\s*(.*)$')
+
 class Config:
     def __init__(self, path):
         self.path = path
-        self.sections = []
         self.need_read = True
         self.need_write = False
+        self._clear_sections()
+
+    def _clear_sections(self):
+        # Sections in file order, indexed by full name, (name, subname) and name.
+        self.sections = []
+        self.sections_by_fullname = {}
+        self.sections_by_key = {}
+        self.sections_by_name = {}
+
+    def _index_section(self, section):
+        self.sections.append(section)
+        self.sections_by_fullname.setdefault(section.fullname, section)
+        self.sections_by_key.setdefault((section.name, section.subname), section)
+        self.sections_by_name.setdefault(section.name, []).append(section)
 
     def __str__(self):
         return "Config '{}'".format(self.path)
@@ -27,29 +44,55 @@ class Config:
         if not self.need_read:
             return
         verbose("Reading {}", self)
-        self.sections = []
         try:
-            section = None
             with open(self.path, 'r') as handle:
-                for lineno, line in enumerate(handle, start=1):
-                    line = line.rstrip('\r\n')
-                    # TODO: Handle comments
-                    # TODO: Handle escapes here? Would make parsing "\"" harder.
-                    # TODO: Handle line continuation
-                    if re.match(r"^\s*$", line):
-                        continue
-                    s = ConfigSection.parse(self, line)
-                    if s:
-                        section = s
-                        continue
-                    v = ConfigVar.parse(section, line)
-                    if v:
-                        continue
-                    error("{}, line {} cannot be parsed:\n>>> {}", self, lineno, line)
-            self.need_read = False            
+                self._parse(handle)
         except IOError, e:
             error("Cannot open {} for reading: {}'", self, e)
 
+    def read_string(self, text):
+        # As read(), but from contents already in memory, such as a blob at some commit.
+        self._parse(cStringIO.StringIO(text))
+
+    def _parse(self, handle):
+        self._clear_sections()
+        section = None
+        for lineno, line in enumerate(handle, start=1):
+            line = line.rstrip('\r\n')
+            # TODO: Handle comments
+            # TODO: Handle escapes here? Would make parsing "\"" harder.
+            # TODO: Handle line continuation
+            if not line.strip():
+                continue
+            # Variables are the most common line, and can never look like a section.
+            if section is not None and ConfigVar.parse(section, line) is not None:
+                continue
+            s = ConfigSection.parse(self, line)
+            if s:
+                section = s
+                continue
+            error("{}, line {} cannot be parsed:\n>>> {}", self, lineno, line)
+        self.need_read = False
+
+    def format(self):
+        handle = cStringIO.StringIO()
+        for b in self.sections:
+            b.write(handle)
+        return handle.getvalue()
+
+    def has_changes(self):
+        # Only needs writing if the contents on disk would change.
+        if not self.need_write:
+            return False
+        try:
+            with open(self.path, 'r') as handle:
+                if handle.read() == self.format():
+                    self.need_write = False
+                    return False
+        except IOError:
+            pass
+        return True
+
     def write(self):
         if not self.need_write:
             return
@@ -59,32 +102,26 @@ class Config:
             return
         try:
             with open(self.path, 'w') as handle:
-                for b in self.sections:
-                    b.write(handle)
+                handle.write(self.format())
             self.need_write = False
         except IOError, e:
             error("Cannot open {} for writing: {}'", self, e)
 
     def __getitem__(self, key):
-        for s in self.sections:
-            if s.fullname == key:
-                return s
-        raise KeyError("Unknown section '{}' in {}".format(key, self))
+        section = self.sections_by_fullname.get(key)
+        if section is None:
+            raise KeyError("Unknown section '{}' in {}".format(key, self))
+        return section
 
     def has_section(self, name, subname=None):
-        for s in self.sections:
-            if s.name == name and s.subname == subname:
-                return True
-        return False
+        return (name, subname) in self.sections_by_key
         
     def add_section(self, name, subname=None):
         self.need_write = True        
         return ConfigSection(self, name, subname)
 
     def sections_named(self, name):
-        for b in self.sections:
-            if b.name == name:
-                yield b
+        return iter(self.sections_by_name.get(name, []))
     
     def debug_dump(self, prefix=""):
         if not opts.args.debug or opts.args.quiet:
@@ -105,16 +142,17 @@ class ConfigSection:
         else:
             self.fullname = name
         self.vars = []
-        config.sections.append(self)
+        self.vars_by_name = {}
+        config._index_section(self)
 
     def __str__(self):
         return self.fullname
         
     @staticmethod
     def parse(config, line):
-        if not config:
+        if config is None:
             return None
-        m = re.match(r'^\s*\[\s*([-a-zA-Z0-9]*)\s*("([^"]*)")?\s*\]\s*$', line)
+        m = _section_re.match(line)
         if not m:
             return None
         section = ConfigSection(config, m.group(1), m.group(3))
@@ -130,27 +168,28 @@ class ConfigSection:
         for v in self.vars:
             v.write(handle)
 
+    def _index_var(self, var):
+        self.vars.append(var)
+        self.vars_by_name.setdefault(var.name, var)
+
     def __getitem__(self, key):
-        for v in self.vars:
-            if v.name == key:
-                return v.value
-        raise KeyError("Unknown variable '{}.{}' in {}".format(self.fullname, key, self.config))
+        v = self.vars_by_name.get(key)
+        if v is None:
+            raise KeyError("Unknown variable '{}.{}' in {}".format(self.fullname, key, self.config))
+        return v.value
 
     def __setitem__(self, key, value):
-        for v in self.vars:
-            if v.name == key:
-                if v.value != value:
-                    v.value = value
-                    self.config.need_write = True
-                return
+        v = self.vars_by_name.get(key)
+        if v is not None:
+            if v.value != value:
+                v.value = value
+                self.config.need_write = True
+            return
         self.config.need_write = True            
         ConfigVar(self, key, value)
 
     def has_key(self, key):
-        for v in self.vars:
-            if v.name == key:
-                return True
-        return False
+        return key in self.vars_by_name
     
     def debug_dump(self, prefix=""):
         prefix = "{}{}.".format(prefix, self.fullname)
@@ -163,19 +202,19 @@ class ConfigVar:
         self.fullname = "{}.{}".format(section.fullname, name)
         self.name = name
         self.value = value
-        section.vars.append(self)
+        section._index_var(self)
 
     def __str__(self):
         return self.value
         
     @staticmethod
     def parse(section, line):
-        if not section:
+        if section is None:
             return None
-        m = re.match(r'^\s*([-a-zA-Z0-9]*)\s*=\s*(.*?)\s*$', line)
+        m = _var_re.match(line)
         if not m:
             return None
-        var = ConfigVar(section, m.group(1), m.group(2))
+        var = ConfigVar(section, m.group(1), m.group(2).rstrip())
         return var
 
     def write(self, handle):
@@ -5,7 +5,9 @@
 # %%LICENSE%%
 #
 import os;
-from dep import config, opts, scm
+import Queue
+import threading
+from dep import cache, config, opts, scm, trace
 from dep.helpers import *
 
 # --------------------------------------------------------------------------------
@@ -17,6 +19,8 @@ class Dependency:
         self.vcs = None
         self.branch = None
         self.commit = None
+        self.depth = None
+        self.filter = None
 
     @staticmethod
     def create_root(root_path):
@@ -59,6 +63,13 @@ class Dependency:
         self.vcs = section["vcs"]
         self.branch = section["branch"]
         self.commit = section["commit"]
+        # Optional clone options, a shallow depth and a partial clone filter such as "blob:none".
+        self.depth = None
+        if section.has_key("depth"):
+            if not section["depth"].isdigit() or int(section["depth"]) == 0:
+                error("{} has invalid depth '{}', must be a positive number", self, section["depth"])
+            self.depth = int(section["depth"])
+        self.filter = section["filter"] if section.has_key("filter") else None
 
     def __str__(self):
         return "Dependency '{}' at {}".format(self.name, self.rel_path)
@@ -73,6 +84,62 @@ class Dependency:
         debug("{}vcs = {}", prefix, self.vcs)
         debug("{}branch = {}", prefix, self.branch)
         debug("{}commit = {}", prefix, self.commit)
+        debug("{}depth = {}", prefix, self.depth)
+        debug("{}filter = {}", prefix, self.filter)
+
+# --------------------------------------------------------------------------------
+class NodeList:
+    # Ordered list of nodes, indexed by name. Inserting or moving a node to either
+    # end only renumbers that node, the full order is rebuilt when next iterated.
+    def __init__(self, nodes=()):
+        self.positions = {}
+        self.by_name = {}
+        self.front = 0
+        self.back = 0
+        self.ordered = []
+        for node in nodes:
+            self.append(node)
+
+    def insert_front(self, node):
+        if self.positions.get(node) == self.front:
+            return
+        self.front -= 1
+        self._place(node, self.front)
+
+    def append(self, node):
+        self._place(node, self.back)
+        self.back += 1
+
+    def move_to_front(self, node):
+        self.insert_front(node)
+
+    def find_by_name(self, name):
+        return self.by_name.get(name)
+
+    def _place(self, node, position):
+        self.positions[node] = position
+        self.by_name.setdefault(node.name, node)
+        self.ordered = None
+
+    def _get_ordered(self):
+        if self.ordered is None:
+            self.ordered = sorted(self.positions, key=self.positions.get)
+        return self.ordered
+
+    def __iter__(self):
+        return iter(self._get_ordered())
+
+    def __reversed__(self):
+        return reversed(self._get_ordered())
+
+    def __getitem__(self, index):
+        return self._get_ordered()[index]
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __contains__(self, node):
+        return node in self.positions
 
 # --------------------------------------------------------------------------------
 class Node:
@@ -84,9 +151,9 @@ class Node:
         self.explicit = False
         self.real_node = None
         self.parent = parent
-        self.children = []
+        self.children = NodeList()
         if parent is not None:
-            parent.children.insert(0, self)
+            parent.children.insert_front(self)
 
     @property
     def name(self):
@@ -114,14 +181,18 @@ class Node:
 
     def read_config(self):
         if self.config.need_read:
-            if self.config.exists():
+            if self.tree.at_rev is not None:
+                self.tree._read_config_at(self)
+            elif self.config.exists():
                 self.config.read()
 
     def write_config(self):
-        if self.config.need_write:
-            self.repository.pre_edit(self.config.path)
-            self.config.write()
-            self.repository.post_edit(self.config.path)
+        if not self.config.has_changes():
+            return False
+        self.repository.pre_edit(self.config.path)
+        self.config.write()
+        self.repository.post_edit(self.config.path)
+        return True
 
     def _validate_has_repository(self):
         if self.repository is None or self.repository.vcs == "file":
@@ -130,6 +201,7 @@ class Node:
     def _build_dependency_tree(self):
         self.read_config()
         child_deps = self.dep.read_children_from_config(self.config)
+        self.tree._prefetch_dependencies(child_deps)
         for child_dep in reversed(child_deps):
             child_node = self.resolve_child_by_dep(child_dep)
             child_node._build_dependency_tree()
@@ -156,11 +228,10 @@ class Node:
                 self.move_child_to_front(implicit_child)
 
     def move_child_to_front(self, child):
-        self.children.remove(child)
-        self.children.insert(0, child)
+        self.children.move_to_front(child)
         
     def find_child_node_by_name(self, name):
-        return next((c for c in self.children if c.name == name), None)
+        return self.children.find_by_name(name)
 
     def find_explicit_node_by_abs_path(self, abs_path):
         if self.real_node.abs_path == abs_path:
@@ -174,14 +245,15 @@ class Node:
         return None
 
     def _get_child_top_node_by_dep(self, dep):
-        for top_node in self.tree.top_nodes:
-            if top_node.name == dep.name:
-                (status, issues) = top_node.dep.resolve_with(dep)
-                if status:
-                    return top_node
-                else:
-                    error("Cannot resolve dependency:\n\t{}\n\t{}\n{}", self.real_node, dep, issues)
-        return self.tree._create_top_node_for_dep(dep)
+        top_node = self.tree.top_nodes.find_by_name(dep.name)
+        if top_node is None:
+            return self.tree._create_top_node_for_dep(dep)
+        if self.real_node in self.tree.refreshed_nodes:
+            self.tree._update_top_node(top_node, dep)
+        (status, issues) = top_node.dep.resolve_with(dep)
+        if not status:
+            error("Cannot resolve dependency:\n\t{}\n\t{}\n{}", self.real_node, dep, issues)
+        return top_node
 
     def _resolve_child_top_node_by_dep(self, dep):
         top_node = self._get_child_top_node_by_dep(dep)
@@ -191,9 +263,9 @@ class Node:
         return top_node
 
     def _resolve_child_link_node(self, top_node):
-        for node in self.children:
-            if isinstance(node, LinkNode) and node.real_node is top_node:
-                return node
+        node = self.children.find_by_name(top_node.name)
+        if isinstance(node, LinkNode) and node.real_node is top_node:
+            return node
         link_node = self.tree._create_link_node(top_node, self)
         link_node.explicit = True
         return link_node
@@ -241,28 +313,36 @@ class Node:
         status("## {}:", self)
         status("##")
         allow_failure = (None if kw is None else kw.get('allow_failure'))
-        old_quiet = opts.args.quiet
-        opts.args.quiet = False
-        run(*cmd, shell=True, cwd=self.abs_path, allow_failure=allow_failure)
-        opts.args.quiet = old_quiet
+        with ForceOutput():
+            run(*cmd, shell=True, cwd=self.abs_path, allow_failure=allow_failure)
 
     def _foreach_run(self, cmd, kw):
-        if self._foreach_run_pre(kw):
-            self._run_command(cmd, kw)
-            self._foreach_run_post(kw)
+        # Returns True if the command was run, the post step is left to the caller.
+        # Dependencies recorded or refreshed by earlier nodes are written before this node runs.
+        if kw.get('foreach_record') and not opts.args.dry_run:
+            self.write_config()
+        if kw.get('foreach_refresh') and not opts.args.dry_run:
+            self.repository.flush_ignore()
+        if not self._foreach_run_pre(kw):
+            return False
+        if kw.get('foreach_stage_all'):
+            self.repository.stage_all()
+        else:
+            self.repository.flush_staging()
+        self._run_command(cmd, kw)
+        return True
 
     def _foreach_run_pre(self, kw):
         if kw.get('foreach_only_modified') and not self.repository.has_local_modifications():
             return False
-        if kw.get('foreach_only_ahead') and not self.repository.is_ahead():
-            return False
         return True
 
-    def _foreach_run_post(self, kw):
+    def _foreach_run_post(self, ran, kw):
+        # A node skipped by the command is still recorded, its HEAD may have moved.
         if kw.get('foreach_record') and not opts.args.dry_run:
-            self.tree.record_dependency_tree()
-        if kw.get('foreach_refresh') and not opts.args.dry_run:
-            self.tree.refresh_dependency_tree()
+            self.tree._record_node(self)
+        if ran and kw.get('foreach_refresh') and not opts.args.dry_run:
+            self.tree._refresh_node(self)
 
     def _merge_dependency_tree(self, branch_name, kw):
         real_node = self.real_node
@@ -317,6 +397,7 @@ class RealNode(Node):
         conf = config.Config(os.path.join(abs_path, ".depconfig"))
         Node.__init__(self, tree, abs_path, dep, conf, parent)
         self.real_node = self
+        trace.register_node(abs_path, self.name)
         parent_repo = None if parent is None else parent.repository
         self.repository = scm.Repository.create(self.abs_path, url=url, name=self.name, parent=parent_repo)
 
@@ -325,6 +406,11 @@ class RealNode(Node):
         self.repository.commit = self.commit
         return self.repository.status(self.rel_path, kw)
 
+    def _status_disk_async(self, kw):
+        self.repository.branch = self.branch
+        self.repository.commit = self.commit
+        return self.repository.status_async(self.rel_path, kw)
+
     def _add_child_node(self, name, rel_path, url, vcs, branch):
         new_dep = Dependency(name)
         new_dep.rel_path = rel_path
@@ -403,6 +489,8 @@ class TopNode(RealNode):
     def __init__(self, tree, dep, parent):
         abs_path = os.path.join(tree.root_node.abs_path, dep.rel_path)
         RealNode.__init__(self, tree, abs_path, dep, parent, dep.url)
+        self.repository.depth = dep.depth
+        self.repository.filter = dep.filter
         
     def _refresh_disk(self):
         verbose("Refresh {}", self)
@@ -417,7 +505,7 @@ class TopNode(RealNode):
         verbose("Record {}\n    to {}", self, to_parent)
         self.repository.branch = self.branch if not force else None
         self.repository.commit = self.commit if not force else None
-        self.repository.record()
+        self.repository.record(None if force else self.tree.ref_snapshot)
         parent_section = to_parent.find_child_config_section(self)
         self.repository.write_state_to_config_section(parent_section)
         if force:
@@ -485,6 +573,122 @@ class TreeList:
                 items.append(local_node)
         return items
         
+# --------------------------------------------------------------------------------
+class TreeSchedule:
+    # Runs a function for each real node in a node list on the shared executor. With
+    # CHILDREN_FIRST a node starts once every listed dependency below it has finished,
+    # with PARENTS_FIRST once every listed node above it has, and UNORDERED any time.
+    CHILDREN_FIRST = "children-first"
+    PARENTS_FIRST = "parents-first"
+    UNORDERED = "unordered"
+    ORDERS = [CHILDREN_FIRST, PARENTS_FIRST, UNORDERED]
+
+    def __init__(self, tree, node_list, order):
+        if order not in TreeSchedule.ORDERS:
+            error("Unknown order '{}', must be one of: {}", order, ", ".join(TreeSchedule.ORDERS))
+        self.nodes = tree._unique_real_nodes(node_list)
+        self.waits_for = dict((node, set()) for node in self.nodes)
+        if order == TreeSchedule.UNORDERED:
+            return
+        below = self._find_listed_below(tree)
+        for node in self.nodes:
+            for child in below[node]:
+                if order == TreeSchedule.CHILDREN_FIRST:
+                    self.waits_for[node].add(child)
+                else:
+                    self.waits_for[child].add(node)
+
+    def _find_listed_below(self, tree):
+        # The nearest listed real nodes below each listed real node, looking through
+        # any real nodes which are not listed.
+        children = {}
+        self._collect_children(tree.root_node, children, set())
+        listed = set(self.nodes)
+        found = {}
+        def listed_below(real_node):
+            if real_node not in found:
+                found[real_node] = set()
+                for child in children.get(real_node, ()):
+                    if child in listed:
+                        found[real_node].add(child)
+                    else:
+                        found[real_node].update(listed_below(child))
+            return found[real_node]
+        return dict((node, listed_below(node)) for node in self.nodes)
+
+    def _collect_children(self, node, children, seen):
+        if node in seen:
+            return
+        seen.add(node)
+        for child in node.children:
+            children.setdefault(node.real_node, set()).add(child.real_node)
+            self._collect_children(child, children, seen)
+
+    def run(self, func, finish=None):
+        # Returns func(node) for each node in list order, showing the output of each as
+        # one block in that order. finish(node, value) is called in this thread as each
+        # node completes. A node is started as soon as the nodes it waits for have finished,
+        # in list order, so with a single job the nodes run one at a time.
+        # After a failure no more nodes are started, the failure is raised once the
+        # running nodes have completed.
+        waiting = dict((node, set(nodes)) for node, nodes in self.waits_for.items())
+        waited_by = dict((node, []) for node in self.nodes)
+        for node, nodes in self.waits_for.items():
+            for other in nodes:
+                waited_by[other].append(node)
+        finished = Queue.Queue()
+        limit = get_executor().jobs
+        jobs = {}
+        running = 0
+        shown = 0
+        failed = False
+        while True:
+            if not failed:
+                for node in self.nodes:
+                    if running == limit:
+                        break
+                    if node not in jobs and not waiting[node]:
+                        jobs[node] = spawn(self._run_node, func, node, finished)
+                        running += 1
+            if running == 0:
+                break
+            node = self._get_finished(finished)
+            running -= 1
+            job = jobs[node]
+            job.wait()
+            if job.failed:
+                failed = True
+            elif not failed:
+                if finish is not None:
+                    finish(node, job.value)
+                for other in waited_by[node]:
+                    waiting[other].discard(node)
+            while shown < len(self.nodes) and self.nodes[shown] in jobs and jobs[self.nodes[shown]].done.is_set():
+                jobs[self.nodes[shown]].flush()
+                shown += 1
+        for node in self.nodes[shown:]:
+            if node in jobs:
+                jobs[node].flush()
+        if not failed and len(jobs) < len(self.nodes):
+            error("Cannot order dependencies, they depend on each other")
+        return [jobs[node].result() for node in self.nodes if node in jobs]
+
+    @staticmethod
+    def _run_node(func, node, finished):
+        try:
+            return func(node)
+        finally:
+            finished.put(node)
+
+    @staticmethod
+    def _get_finished(finished):
+        # Wait with a timeout so that the waiting thread can still be interrupted.
+        while True:
+            try:
+                return finished.get(True, 0.1)
+            except Queue.Empty:
+                pass
+
 # --------------------------------------------------------------------------------
 class Tree:
     def __init__(self, root_path=None):
@@ -494,8 +698,18 @@ class Tree:
                 error("Cannot find root dependency working directory from '{}'", os.getcwd())
         root_path = os.path.realpath(root_path)
         self.root_node = self._create_root_node_for_path(root_path)
-        self.top_nodes = []
+        self.top_nodes = NodeList()
+        self.top_nodes_by_url = {}
+        self.top_nodes_by_abs_path = {}
         self.refresh_mode = False
+        self.at_rev = None
+        self.ref_snapshot = None
+        self.explicit_nodes = None
+        self.refreshed_nodes = set()
+        self.created_nodes = 0
+        self.prefetch = False
+        self.downloads = {}
+        self.downloads_lock = threading.Lock()
 
     # --------------------------------------------------------------------------------
     # Begin General Tree API
@@ -510,6 +724,10 @@ class Tree:
     def branch_dependency_tree(self, branch_name, branch_startpoint, kw):
         self._validate_has_repository()        
         self.read_dependency_tree()
+        if kw.get('refs_only'):
+            startpoint = "HEAD" if branch_startpoint is None else branch_startpoint
+            self._create_refs_dependency_tree([("refs/heads/{}".format(branch_name), startpoint)], kw)
+            return
         self._branch_dependency_tree_create(branch_name, branch_startpoint, kw)
         self.record_dependency_tree()
         self._branch_dependency_tree_commit(branch_name, branch_startpoint, kw)        
@@ -532,27 +750,57 @@ class Tree:
         tree.refresh_dependency_tree()
         
     def commit_dependency_tree(self, commit_args, kw):
-        # TODO: Should call self.repository to do work!
-        self.foreach_dependency(["git", "add", "--all", "."], kw)
-        if kw.get('foreach_force_all'):
-            kw.update(foreach_record=True, foreach_only_modified=False)
-        else:
-            kw.update(foreach_record=True, foreach_only_modified=True)
+        # One pass from the leaves up, each modified repository has all its changes staged
+        # and committed, then its new commit is recorded in its parents before they run.
+        kw.update(foreach_record=True, foreach_stage_all=True, foreach_order=TreeSchedule.CHILDREN_FIRST,
+                  foreach_only_modified=not kw.get('foreach_force_all'))
         self.foreach_dependency(["git", "commit"] + commit_args, kw)
         
+    def fetch_dependency_tree(self, fetch_args, kw):
+        self._validate_has_repository()
+        self.read_dependency_tree()
+        # Shared dependencies can be listed more than once, only fetch each one once.
+        node_list = self._unique_real_nodes(TreeList(self, kw).build())
+        host_limit = KeyedLimit(kw.get('jobs_per_host'))
+        jobs = [node.repository.fetch_async(fetch_args, host_limit) for node in node_list]
+        results = zip(node_list, gather(jobs))
+        total_seconds = 0.0
+        total_size = 0
+        status("")
+        status("    Time      Size Path")
+        for node, (seconds, size) in results:
+            total_seconds += seconds
+            total_size += size
+            status("{:7.1f}s {:>9} {}", seconds, format_size(size), node.rel_path)
+        status("{:7.1f}s {:>9} total for {} repositories", total_seconds, format_size(total_size), len(results))
+
     def foreach_dependency(self, cmd, kw):
         self._validate_has_repository()        
         self.read_dependency_tree()
+        # Commands run in each repository should see every file edited so far staged.
+        scm.flush_staging()
         node_list = TreeList(self, kw).build()
-        for node in node_list:
-            node.real_node._foreach_run(cmd, kw)
+        if kw.get('foreach_only_ahead'):
+            node_list = self._filter_ahead(node_list)
+            kw = dict(kw, foreach_only_ahead=False)
+        if kw.get('foreach_record') and not opts.args.dry_run:
+            self.ref_snapshot = self._get_ref_snapshot()
+        # Each post step runs here, before any node waiting for that node starts.
+        def finish(node, ran):
+            node._foreach_run_post(ran, kw)
+        schedule = TreeSchedule(self, node_list, kw.get('foreach_order') or TreeSchedule.CHILDREN_FIRST)
+        schedule.run(lambda node: node._foreach_run(cmd, kw), finish)
+        self._foreach_dependency_finish(kw)
 
     def init_dependency(self):
         self.root_node._init_disk()
 
     def list_dependency_tree(self, kw):
         self._validate_has_repository()        
-        self.read_dependency_tree()
+        if kw.get('list_at'):
+            self.read_dependency_tree_at(kw['list_at'])
+        else:
+            self.read_dependency_tree()
         node_list = TreeList(self, kw).build()
         for node in node_list:
             print node.name
@@ -564,23 +812,60 @@ class Tree:
         node._merge_dependency_tree(branch_name, kw)
         self._write_config_dependency_tree()
             
+    def pull_dependency_tree(self, kw):
+        # Every repository is fetched first, then fast-forwarded without any network access,
+        # so no fetch waits for a merge. Branches which have diverged are only reported.
+        self._validate_has_repository()
+        self.read_dependency_tree()
+        node_list = self._unique_real_nodes(TreeList(self, kw).build())
+        host_limit = KeyedLimit(kw.get('jobs_per_host'))
+        list(gather([node.repository.fetch_async([], host_limit) for node in node_list]))
+        merged = gather([node.repository.fast_forward_async() for node in node_list])
+        diverged = [node for node, is_merged in zip(node_list, merged) if not is_merged]
+        if diverged:
+            error("Cannot fast-forward, merge needed for:\n    {}", "\n    ".join(str(node) for node in diverged))
+
     def read_dependency_tree(self):
         self.refresh_mode = False
         self._build_dependency_tree()
         self.debug_dump("read:")
 
+    def read_dependency_tree_at(self, rev):
+        # The tree recorded by the root at 'rev', with each .depconfig read at the commit
+        # its parent records, so nothing needs to be checked out.
+        self.refresh_mode = False
+        self.at_rev = rev
+        try:
+            self.root_node._build_dependency_tree()
+            self.root_node._add_implicit_children()
+        finally:
+            for node in self._real_nodes():
+                node.repository.close_blobs()
+        self.debug_dump("read at {}:".format(rev))
+
     def refresh_dependency_tree(self):
         self._validate_has_repository()
         self.refresh_mode = True
-        self._build_dependency_tree()
+        self.prefetch = opts.args.jobs > 1
+        try:
+            self._build_dependency_tree()
+        finally:
+            self._finish_downloads()
+        self._flush_ignores()
         self.debug_dump("refresh:")
 
     def record_dependency_tree(self):
         self._validate_has_repository()        
         self.refresh_mode = False
         self._build_dependency_tree()
+        # Repositories unchanged since last recorded are not read again.
+        self.ref_snapshot = self._get_ref_snapshot()
         self._record_dependency_tree()
-        self._write_config_dependency_tree()
+        if self._write_config_dependency_tree():
+            self._save_dependency_tree()
+        if self.ref_snapshot is not None:
+            self.ref_snapshot.save()
+            self.ref_snapshot = None
         self.debug_dump("record:")        
 
     def status_dependency_tree(self, kw):
@@ -591,15 +876,18 @@ class Tree:
         self._validate_has_repository()        
         self.read_dependency_tree()
         node_list = TreeList(self, kw).build()
-        kw['status_first'] = True
-        is_clean = True
-        for node in node_list:
-            if not node.real_node._status_disk(kw):
-                is_clean = False
-            kw['status_first'] = False
+        # Status is read only, so query all nodes at once but show rows in list order.
+        jobs = [node.real_node._status_disk_async(dict(kw, status_first=(i == 0)))
+                for i, node in enumerate(node_list)]
+        is_clean = all(list(gather(jobs)))
         if kw.get('status_exit'):
             sys.exit(0 if is_clean else 1)
 
+    def tag_dependency_tree(self, tag_name, kw):
+        self._validate_has_repository()
+        self.read_dependency_tree()
+        self._create_refs_dependency_tree([("refs/tags/{}".format(tag_name), "HEAD")], kw)
+
     def worktree_dependency_tree(self, branch_name):
         new_repo = self.root_node.repository.create_worktree(branch_name)
         new_tree = Tree(new_repo.work_dir)
@@ -625,6 +913,16 @@ class Tree:
 
     # --------------------------------------------------------------------------------
 
+    def _unique_real_nodes(self, node_list):
+        real_nodes = []
+        seen = set()
+        for node in node_list:
+            if node.real_node in seen:
+                continue
+            seen.add(node.real_node)
+            real_nodes.append(node.real_node)
+        return real_nodes
+
     def _get_root_or_local_node(self):
         node = self.root_node
         if opts.args.local:
@@ -632,8 +930,106 @@ class Tree:
         return node
 
     def _build_dependency_tree(self):
+        is_empty = not self.top_nodes and not self.root_node.children
+        if is_empty and not self.refresh_mode and self._load_dependency_tree():
+            return
         self.root_node._build_dependency_tree()
         self.root_node._add_implicit_children()
+        if is_empty:
+            self._save_dependency_tree()
+
+    def _get_cache_dir(self):
+        repository = self.root_node.repository
+        if not isinstance(repository, scm.GitRepository) or not os.path.isdir(repository.git_dir):
+            return None
+        return repository.git_dir
+
+    def _get_tree_cache(self):
+        cache_dir = self._get_cache_dir()
+        if cache_dir is None:
+            return None
+        return cache.TreeCache(cache_dir)
+
+    def _get_ref_snapshot(self):
+        cache_dir = self._get_cache_dir()
+        if cache_dir is None:
+            return None
+        ref_snapshot = cache.RefSnapshot(cache_dir)
+        ref_snapshot.load()
+        return ref_snapshot
+
+    def _real_nodes(self):
+        return [self.root_node] + list(self.top_nodes)
+
+    def _save_dependency_tree(self):
+        tree_cache = self._get_tree_cache()
+        if tree_cache is None:
+            return
+        real_nodes = self._real_nodes()
+        data = {
+            'top_nodes': [self._save_dep(n.dep) for n in self.top_nodes],
+            'config_sections': dict((n.config.path, self._save_config(n.config)) for n in real_nodes),
+            'children': self._save_children(self.root_node),
+        }
+        tree_cache.save(self.root_node.abs_path, [n.config.path for n in real_nodes], data)
+
+    def _save_dep(self, dep):
+        return (dep.name, dep.rel_path, dep.url, dep.vcs, dep.branch, dep.commit, dep.depth, dep.filter)
+
+    def _save_config(self, conf):
+        if conf.need_read:
+            return None
+        return [(s.name, s.subname, [(v.name, v.value) for v in s.vars]) for s in conf.sections]
+
+    def _save_children(self, node):
+        return [(isinstance(c, LinkNode), c.name, c.explicit, self._save_children(c)) for c in node.children]
+
+    def _load_dependency_tree(self):
+        tree_cache = self._get_tree_cache()
+        if tree_cache is None:
+            return False
+        data = tree_cache.load(self.root_node.abs_path)
+        if data is None:
+            return False
+        top_nodes_by_name = {}
+        for fields in data['top_nodes']:
+            dep = Dependency(fields[0])
+            (dep.rel_path, dep.url, dep.vcs, dep.branch, dep.commit, dep.depth, dep.filter) = fields[1:]
+            top_node = TopNode(self, dep, self.root_node)
+            top_nodes_by_name[dep.name] = top_node
+            self._add_top_node(top_node)
+        for node in self._real_nodes():
+            self._load_config(node.config, data['config_sections'].get(node.config.path))
+        self.root_node.children = self._load_children(self.root_node, data['children'], top_nodes_by_name)
+        return True
+
+    def _load_config(self, conf, sections):
+        if sections is None:
+            return
+        for name, subname, variables in sections:
+            section = config.ConfigSection(conf, name, subname)
+            for var_name, value in variables:
+                config.ConfigVar(section, var_name, value)
+        conf.need_read = False
+        conf.need_write = False
+
+    def _load_children(self, parent, records, top_nodes_by_name):
+        children = NodeList()
+        for is_link, name, explicit, child_records in records:
+            top_node = top_nodes_by_name[name]
+            node = LinkNode(top_node, parent) if is_link else top_node
+            node.explicit = explicit
+            node.children = self._load_children(node, child_records, top_nodes_by_name)
+            children.append(node)
+        return children
+
+    def _read_config_at(self, node):
+        real_node = node.real_node
+        rev = self.at_rev if real_node is self.root_node else real_node.commit
+        if rev is None:
+            error("{} has no recorded commit", real_node)
+        verbose("Reading {} at {}", real_node.config, rev)
+        real_node.config.read_string(real_node.repository.read_blob(rev, ".depconfig") or "")
 
     def _refresh_disk(self, node):
         if self.refresh_mode:
@@ -642,11 +1038,91 @@ class Tree:
     def _record_dependency_tree(self):
         self.root_node._record_dependency_tree()
 
+    def _filter_ahead(self, node_list):
+        # Checked for every repository at once, rather than as the turn of each comes.
+        real_nodes = self._unique_real_nodes(node_list)
+        jobs = [node.repository.is_ahead_async() for node in real_nodes]
+        return [node for node, ahead in zip(real_nodes, gather(jobs)) if ahead]
+
+    def _foreach_dependency_finish(self, kw):
+        # Write whatever was recorded or refreshed for each node, once at the end.
+        if not (kw.get('foreach_record') or kw.get('foreach_refresh')) or opts.args.dry_run:
+            return
+        self._write_config_dependency_tree()
+        self._flush_ignores()
+        self._save_dependency_tree()
+        if self.ref_snapshot is not None:
+            self.ref_snapshot.save()
+            self.ref_snapshot = None
+
+    def _flush_ignores(self):
+        # Ignore files are only written once each, after the whole tree has been refreshed.
+        for node in self._real_nodes():
+            node.repository.flush_ignore()
+
+    def _get_explicit_nodes(self, real_node):
+        # The explicit nodes of each real node, each has a section in its parent's config.
+        if self.explicit_nodes is None:
+            self.explicit_nodes = {}
+            self._index_explicit_nodes(self.root_node)
+        return self.explicit_nodes.get(real_node, [])
+
+    def _index_explicit_nodes(self, node):
+        self.explicit_nodes.setdefault(node.real_node, []).append(node)
+        for child in node.children:
+            if child.explicit is True:
+                self._index_explicit_nodes(child)
+
+    def _record_node(self, real_node):
+        # Record one repository in the in-memory config of each parent which lists it.
+        recorded = set()
+        for node in self._get_explicit_nodes(real_node):
+            if node.parent is None or node.parent.real_node in recorded:
+                continue
+            recorded.add(node.parent.real_node)
+            real_node._record_disk(node.parent.real_node)
+
+    def _refresh_node(self, real_node):
+        # Refresh the dependencies of one node, as its config may have been changed.
+        self.refresh_mode = True
+        self.refreshed_nodes = set([real_node])
+        created_nodes = self.created_nodes
+        real_node.config.need_read = True
+        for node in self._get_explicit_nodes(real_node):
+            node._build_dependency_tree()
+        if self.created_nodes != created_nodes:
+            self.root_node._add_implicit_children()
+            self.explicit_nodes = None
+        self.refreshed_nodes = set()
+        self.refresh_mode = False
+
+    def _update_top_node(self, top_node, dep):
+        # A refreshed parent may list a new branch or commit of an existing dependency,
+        # which is checked out, and its own dependencies refreshed in turn.
+        if top_node.dep.branch == dep.branch and top_node.dep.commit == dep.commit:
+            return
+        top_node.dep.branch = dep.branch
+        top_node.dep.commit = dep.commit
+        top_node.config.need_read = True
+        self.refreshed_nodes.add(top_node)
+        self._refresh_disk(top_node)
+
     def _branch_dependency_tree_create(self, branch_name, branch_startpoint, kw):
+        # Each repository branches on its own, so the order does not matter.
         node_list = TreeList(self, kw).build()
-        for node in node_list:
-            node.repository.create_branch(branch_name, branch_startpoint)
+        schedule = TreeSchedule(self, node_list, TreeSchedule.UNORDERED)
+        schedule.run(lambda node: node.repository.create_branch(branch_name, branch_startpoint))
         
+    def _create_refs_dependency_tree(self, refs, kw):
+        # Every repository creates its refs at once, and all are tried before any failure
+        # is reported.
+        node_list = self._unique_real_nodes(TreeList(self, kw).build())
+        created = gather([node.repository.create_refs_async(refs) for node in node_list])
+        failed = [node for node, is_created in zip(node_list, created) if not is_created]
+        if failed:
+            error("Cannot create {} in:\n    {}", ", ".join(ref for ref, startpoint in refs),
+                  "\n    ".join(str(node) for node in failed))
+
     def _branch_dependency_tree_commit(self, branch_name, branch_startpoint, kw):
         starting_msg = (" with start point '{}'".format(branch_startpoint) if branch_startpoint is not None else "")
         commit_msg = "Created branch '{}'{}".format(branch_name, starting_msg)
@@ -654,29 +1130,93 @@ class Tree:
         self.commit_dependency_tree(["--allow-empty", "-m", commit_msg], kw)
 
     def _write_config_dependency_tree(self):
+        # Returns True if any configuration was written.
+        written = False
         for top_node in self.top_nodes:
-            top_node.write_config()
-        self.root_node.write_config()
+            if top_node.write_config():
+                written = True
+        if self.root_node.write_config():
+            written = True
+        return written
         
     def _create_root_node_for_path(self, root_path):
         root_node = RootNode(self, root_path)
         return root_node
 
+    def _create_repository_for_dep(self, dep):
+        abs_path = os.path.join(self.root_node.abs_path, dep.rel_path)
+        repository = scm.Repository.create(abs_path, url=dep.url, name=dep.name, parent=self.root_node.repository)
+        repository.depth = dep.depth
+        repository.filter = dep.filter
+        return repository
+
+    def _prefetch_dependencies(self, deps):
+        # Start downloading missing dependencies in the background, in refresh mode
+        # the tree walk will then wait for each download in turn.
+        with self.downloads_lock:
+            if not self.prefetch:
+                return
+            for dep in deps:
+                if dep.name in self.downloads:
+                    continue
+                repository = self._create_repository_for_dep(dep)
+                if os.path.exists(repository.git_dir):
+                    continue
+                self.downloads[dep.name] = spawn(self._prefetch_dependency, dep, repository)
+
+    def _prefetch_dependency(self, dep, repository):
+        repository.branch = dep.branch
+        repository.commit = dep.commit
+        repository.refresh()
+        # Read the new dependency configuration now, so its children can start downloading.
+        conf = config.Config(os.path.join(repository.work_dir, ".depconfig"))
+        if conf.exists():
+            conf.read()
+            self._prefetch_dependencies(dep.read_children_from_config(conf))
+
+    def _wait_for_download(self, dep):
+        with self.downloads_lock:
+            job = self.downloads.get(dep.name)
+        if job is None:
+            return
+        job.wait()
+        job.flush()
+        job.result()
+
+    def _finish_downloads(self):
+        # Downloads not yet started are no longer needed, wait for the others.
+        with self.downloads_lock:
+            self.prefetch = False
+            jobs = self.downloads.values()
+            self.downloads = {}
+        for job in jobs:
+            job.cancel()
+        for job in jobs:
+            job.wait()
+            job.flush()
+
     def _create_top_node_for_dep(self, dep):
+        self._wait_for_download(dep)
         top_node = TopNode(self, dep, self.root_node)
-        self.top_nodes.append(top_node)
+        self._add_top_node(top_node)
+        self.created_nodes += 1
         self._refresh_disk(top_node)
         return top_node
 
+    def _add_top_node(self, top_node):
+        self.top_nodes.append(top_node)
+        self.top_nodes_by_url.setdefault(top_node.url, top_node)
+        self.top_nodes_by_abs_path.setdefault(top_node.abs_path, top_node)
+
     def _create_link_node(self, top_node, parent):
         link_node = LinkNode(top_node, parent)
+        self.created_nodes += 1
         self._refresh_disk(link_node)        
         return link_node
 
     def _move_top_node_to_front(self, top_node):
         self.root_node.move_child_to_front(top_node)
-        self.top_nodes.remove(top_node)
-        self.top_nodes.insert(0, top_node)
+        self.top_nodes.move_to_front(top_node)
 
     def _find_local_node(self):
         local_work_dir = find_local_work_dir()
@@ -693,26 +1233,17 @@ class Tree:
     def _find_real_node_by_abs_path(self, abs_path):
         if self.root_node.abs_path == abs_path:
             return self.root_node
-        for top_node in self.top_nodes:
-            if top_node.abs_path == abs_path:
-                return top_node
-        return None
+        return self.top_nodes_by_abs_path.get(abs_path)
 
     def _find_real_node_by_url(self, url):
         if self.root_node.url == url:
             return self.root_node
-        for top_node in self.top_nodes:
-            if top_node.url == url:
-                return top_node
-        return None
+        return self.top_nodes_by_url.get(url)
 
     def _find_real_node_by_name(self, name):
         if self.root_node.name == name:
             return self.root_node
-        for top_node in self.top_nodes:
-            if top_node.name == name:
-                return top_node
-        return None
+        return self.top_nodes.find_by_name(name)
     
     def __str__(self):
         return "Tree '{}' at {}".format(self.root_node.name, self.root_node.abs_path)
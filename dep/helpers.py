@@ -8,15 +8,39 @@ import sys
 import os
 import subprocess
 import re
-from dep import opts
+import argparse
+import threading
+import Queue
+from dep import opts, trace
+
+# Per thread output state, see OutputCapture and ForceOutput.
+_thread_state = threading.local()
+_output_lock = threading.Lock()
 
 def get_program_path():
     return os.path.realpath(__file__)
 
+def write_stdout(text):
+    capture = getattr(_thread_state, "capture", None)
+    if capture is not None:
+        capture.stdout.append(text)
+    else:
+        sys.stdout.write(text)
+
+def write_stderr(text):
+    capture = getattr(_thread_state, "capture", None)
+    if capture is not None:
+        capture.stderr.append(text)
+    else:
+        sys.stderr.write(text)
+
+def is_quiet():
+    if getattr(_thread_state, "force_output", False):
+        return False
+    return opts.args.quiet
+
 def error(fmt, *a):
-    sys.stderr.write("dep: ")
-    sys.stderr.write(fmt.format(*a))
-    sys.stderr.write("\n")
+    write_stderr("dep: {}\n".format(fmt.format(*a)))
     sys.exit(1)
 
 def debug(fmt, *a):
@@ -30,10 +54,9 @@ def verbose(fmt, *a):
     status(fmt, *a)
 
 def status(fmt, *a):
-    if opts.args.quiet:
+    if is_quiet():
         return
-    sys.stdout.write(fmt.format(*a))
-    sys.stdout.write("\n")
+    write_stdout("{}\n".format(fmt.format(*a)))
 
 def status_seperator():
     columns = int(os.environ["COLUMNS"])
@@ -100,6 +123,9 @@ def run(*cmd, **kw):
     query = kw.get('query')
     pipe = kw.get('pipe')
     allow_failure = kw.get('allow_failure')
+    # Data written to the standard input of the command, if any.
+    input = kw.get('input')
+    stdin = None if input is None else subprocess.PIPE
     if not query and not pipe:
         if cwd:
             verbose("-> pushd {}", cwd)
@@ -109,26 +135,55 @@ def run(*cmd, **kw):
     if opts.args.dry_run and not query and not pipe:
         status("{}", cmd_text)
         return
+    capture = getattr(_thread_state, "capture", None)
+    # A Pipe is traced until it is closed, see Pipe.
+    span = (trace.begin(cmd, cwd) if not pipe else None)
     try:
         if query:
-            return subprocess.check_output(cmd, stderr=subprocess.STDOUT, cwd=cwd)
+            output = subprocess.check_output(cmd, stderr=subprocess.STDOUT, cwd=cwd)
+            span.exit_status = 0
+            span.size = len(output)
+            return output
         elif pipe:
             return subprocess.Popen(cmd, stdout=subprocess.PIPE, cwd=cwd)            
-        elif opts.args.quiet:
+        elif capture is not None:
+            process = subprocess.Popen(cmd, stdin=stdin, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=cwd)
+            (out, err) = process.communicate(input)
+            exit_status = process.returncode
+            span.size = len(out) + len(err)
+            if not is_quiet():
+                capture.stdout.append(out)
+            capture.stderr.append(err)
+        elif is_quiet():
             with open(os.devnull, "wb") as dev_null:
-                exit_status = subprocess.call(cmd, stdout=dev_null, cwd=cwd)
+                process = subprocess.Popen(cmd, stdin=stdin, stdout=dev_null, cwd=cwd)
+                process.communicate(input)
+                exit_status = process.returncode
         else:
-            exit_status = subprocess.call(cmd, cwd=cwd)
+            process = subprocess.Popen(cmd, stdin=stdin, cwd=cwd)
+            process.communicate(input)
+            exit_status = process.returncode
+        span.exit_status = exit_status
         if exit_status != 0:
             msg = "Execution of '{}' returned exit status {}".format(cmd_text, exit_status)
             if allow_failure:
                 status("{}", msg)
             else:
                 error("{}", msg)
+        return exit_status
     except OSError, e:
         error("Cannot execute '{}': {}'", cmd_text, e)
+    except subprocess.CalledProcessError, e:
+        span.exit_status = e.returncode
+        span.size = len(e.output)
+        if allow_failure:
+            return None
+        error("{}", e)
     except Exception, e:
         error("{}", e)
+    finally:
+        if span is not None:
+            span.finish()
 
 def run_query(*cmd, **kw):
     return run(*cmd, query=True, **kw)
@@ -142,21 +197,263 @@ def make_dirs(dir):
     try:
         os.makedirs(dir)
     except OSError, e:
-        error("Cannot make directory path '{}'", dir)
+        # Another thread may have created the same directory meanwhile.
+        if not os.path.isdir(dir):
+            error("Cannot make directory path '{}'", dir)
+
+class OutputCapture:
+    # Collects status, error and command output of the current thread so it can be
+    # shown later as one block, rather than interleaved with other threads.
+    def __init__(self):
+        self.stdout = []
+        self.stderr = []
+        self.previous = None
+
+    def __enter__(self):
+        self.previous = getattr(_thread_state, "capture", None)
+        _thread_state.capture = self
+        return self
+
+    def __exit__(self, type, value, traceback):
+        _thread_state.capture = self.previous
+
+    def flush(self):
+        with _output_lock:
+            sys.stdout.write(''.join(self.stdout))
+            sys.stdout.flush()
+            sys.stderr.write(''.join(self.stderr))
+            sys.stderr.flush()
+        self.stdout = []
+        self.stderr = []
+
+class ForceOutput:
+    # Show output of the current thread even if --quiet was given.
+    def __enter__(self):
+        self.previous = getattr(_thread_state, "force_output", False)
+        _thread_state.force_output = True
+
+    def __exit__(self, type, value, traceback):
+        _thread_state.force_output = self.previous
+
+class Job:
+    # A call run by the executor, see spawn(). When run on another thread its output is
+    # collected in 'capture', to be shown by flush() in the waiting thread.
+    def __init__(self, func, args, capture=None):
+        self.func = func
+        self.args = args
+        self.capture = capture
+        self.value = None
+        self.exc_info = None
+        self.started = False
+        self.cancelled = False
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+
+    def run(self):
+        with self.lock:
+            if self.cancelled:
+                return
+            self.started = True
+        try:
+            if self.capture is None:
+                self.value = self.func(*self.args)
+            else:
+                with self.capture:
+                    self.value = self.func(*self.args)
+        except BaseException:
+            # Includes SystemExit from error(), re-raised by result() in the waiting thread.
+            self.exc_info = sys.exc_info()
+        self.done.set()
+
+    def cancel(self):
+        # Only a job which has not started can be cancelled, a running job completes.
+        with self.lock:
+            if self.started:
+                return
+            self.cancelled = True
+        self.done.set()
+
+    @property
+    def failed(self):
+        return self.exc_info is not None
+
+    def wait(self):
+        # Wait with a timeout so that the waiting thread can still be interrupted.
+        while not self.done.is_set():
+            self.done.wait(0.1)
+
+    def flush(self):
+        if self.capture is not None:
+            self.capture.flush()
+
+    def result(self):
+        self.wait()
+        if self.exc_info is not None:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.value
+
+class Executor:
+    # Runs jobs on up to 'jobs' threads, shared by every operation; with a single job
+    # each job runs inline when submitted, and any failure is raised straight away.
+    # A job must not wait for another job, it may only submit more.
+    def __init__(self, jobs=1):
+        self.jobs = max(1, jobs)
+        self.queue = Queue.Queue()
+        self.threads = []
+        self.lock = threading.Lock()
+
+    def submit(self, func, *args):
+        if self.jobs == 1:
+            job = Job(func, args)
+            job.run()
+            job.result()
+            return job
+        job = Job(func, args, OutputCapture())
+        self.queue.put(job)
+        with self.lock:
+            if len(self.threads) < self.jobs:
+                self._start_thread()
+        return job
+
+    def _start_thread(self):
+        thread = threading.Thread(target=self._worker)
+        thread.daemon = True
+        self.threads.append(thread)
+        thread.start()
+
+    def _worker(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+            job.run()
+
+    def close(self):
+        # Jobs not yet started are cancelled, as after an interrupt or failure nothing will
+        # wait for them. The threads stop once their running jobs are done, so no thread
+        # is still running when the program exits.
+        with self.lock:
+            threads = self.threads
+            self.threads = []
+        while True:
+            try:
+                job = self.queue.get_nowait()
+            except Queue.Empty:
+                break
+            if job is not None:
+                job.cancel()
+        for thread in threads:
+            self.queue.put(None)
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(0.1)
+
+# The executor for this run, see get_executor().
+_executor = None
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        _executor = Executor(opts.args.jobs)
+    return _executor
+
+def close_executor():
+    global _executor
+    if _executor is not None:
+        _executor.close()
+        _executor = None
+
+def spawn(func, *args):
+    # Starts func(*args) on the executor, returns its Job.
+    return get_executor().submit(func, *args)
+
+def gather(jobs):
+    # Yields the value of each job in order, showing the output of each as one block.
+    # After a failure the jobs not yet started are cancelled, the output of those
+    # already running is still shown, then the failure is raised. If the waiting thread
+    # is interrupted, or stops early, the jobs not yet started are also cancelled.
+    failed_job = None
+    try:
+        for job in jobs:
+            job.wait()
+            job.flush()
+            if failed_job is not None:
+                continue
+            if job.failed:
+                failed_job = job
+                for other_job in jobs:
+                    other_job.cancel()
+            else:
+                yield job.value
+    finally:
+        for job in jobs:
+            job.cancel()
+    if failed_job is not None:
+        failed_job.result()
+
+class KeyedLimit:
+    # Limits how many threads may hold the same key at once, no limit if None.
+    def __init__(self, limit=None):
+        self.limit = limit
+        self.lock = threading.Lock()
+        self.semaphores = {}
+
+    def hold(self, key):
+        if self.limit is None:
+            return _NoLimit()
+        with self.lock:
+            if key not in self.semaphores:
+                self.semaphores[key] = threading.BoundedSemaphore(self.limit)
+            return self.semaphores[key]
+
+class _NoLimit:
+    def __enter__(self):
+        pass
+
+    def __exit__(self, type, value, traceback):
+        pass
 
 class Pipe:
     def __init__(self, *cmd, **kw):
+        self.span = trace.begin(filter(None, cmd), kw.get('cwd'))
         self.process = run(*cmd, pipe=True, **kw)
         self.cmd_text = ' '.join(filter(None, cmd))        
+        self.output = PipeOutput(self.process.stdout)
 
     def __enter__(self):
-        return self.process.stdout
+        return self.output
 
     def __exit__(self, type, value, traceback):
         exit_status = self.process.wait()
+        self.span.exit_status = exit_status
+        self.span.size = self.output.size
+        self.span.finish()
         if exit_status != 0:
             error("{} returned exit code {}", self.cmd_text, exit_status)
 
+class PipeOutput:
+    # Unbuffered reads from the output of a Pipe, counting the bytes read.
+    def __init__(self, handle):
+        self.handle = handle
+        self.size = 0
+
+    def fileno(self):
+        return self.handle.fileno()
+
+    def read(self, size):
+        data = os.read(self.handle.fileno(), size)
+        self.size += len(data)
+        return data
+
+def format_size(size):
+    for unit in ["B", "K", "M", "G"]:
+        if size < 1024 or unit == "G":
+            break
+        size = size / 1024.0
+    if unit == "B":
+        return "{}{}".format(size, unit)
+    return "{:.1f}{}".format(size, unit)
+
 def find_local_work_dir(path=None):
     if path is None:
         path = os.getcwd()
@@ -206,6 +503,14 @@ def add_local_arguments(parser):
     parser.add_argument("--root", dest="local", action="store_false",
                         help="Add the new dependency under the root dependency (default).")
     
+def add_jobs_arguments(parser):
+    parser.add_argument("-j", "--jobs", dest="jobs", type=int, metavar="N", default=argparse.SUPPRESS,
+                        help="Run for up to N dependencies at once (default 1)")
+
+def add_jobs_per_host_arguments(parser):
+    parser.add_argument("--jobs-per-host", dest="jobs_per_host", type=int, metavar="N",
+                        help="Run for up to N dependencies at once with the same remote host")
+
 def add_list_arguments(parser):
     parser.add_argument("--no-root", dest="list_root", action="store_false",
                         help="Do not include the root project in list of dependencies")
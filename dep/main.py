@@ -4,8 +4,8 @@
 # %%LICENSE%%
 #
 import sys
-from dep import opts, helpers
-from dep.cmd import *
+from dep import opts, helpers, scm, trace
+from dep import cmd
 
 def main():
     if len(sys.argv) == 1:
@@ -13,9 +13,16 @@ def main():
         sys.exit(0)
 
     (opts.args, opts.rest_args) = opts.parser.parse_known_args()
+    if opts.args.trace:
+        trace.enable(opts.args.trace, "dep {}".format(opts.args.subparser_name), sys.argv[1:])
     if len(opts.rest_args) > 0:
         if opts.args.subparser_name not in opts.allow_rest:
             opts.parser.print_usage()
             helpers.error("unrecognized options: {}", *opts.rest_args)
-    opts.args.func(opts.args)
+    try:
+        opts.args.func(opts.args)
+        # Edited files are staged once, at the end of the command.
+        scm.flush_staging()
+    finally:
+        helpers.close_executor()
     sys.exit(0)
@@ -4,7 +4,39 @@
 #
 # %%LICENSE%%
 #
+import os
 import argparse
+import importlib
+import collections
+
+class _CommandParserMap(collections.OrderedDict):
+    # Command name to subparser, importing the command module the first time its
+    # subparser is needed. The module adds the subparser with add_parser.
+    def __init__(self):
+        collections.OrderedDict.__init__(self)
+        self.modules = {}
+
+    def add_module(self, name, module):
+        self.modules[name] = module
+        self[name] = None
+
+    def __getitem__(self, name):
+        subparser = collections.OrderedDict.__getitem__(self, name)
+        if subparser is None:
+            importlib.import_module(self.modules[name])
+            subparser = collections.OrderedDict.__getitem__(self, name)
+        return subparser
+
+class _CommandSubParsersAction(argparse._SubParsersAction):
+    # Subparsers which can be listed, with their help, before they are created.
+    def __init__(self, *args, **kwargs):
+        argparse._SubParsersAction.__init__(self, *args, **kwargs)
+        self._name_parser_map = _CommandParserMap()
+        self.choices = self._name_parser_map
+
+    def add_command(self, name, module, help):
+        self._choices_actions.append(self._ChoicesPseudoAction(name, help))
+        self._name_parser_map.add_module(name, module)
 
 global parser
 global subparsers
@@ -13,11 +45,15 @@ global allow_rest
 
 parser = argparse.ArgumentParser(description="Manages component based dependencies using version control systems (VCS).")
 
-subparsers = parser.add_subparsers(title="command arguments", dest="subparser_name")
+subparsers = parser.add_subparsers(title="command arguments", dest="subparser_name",
+                                   action=_CommandSubParsersAction)
 
 args = []
 allow_rest = []
 
+# Commands which support parallel operation add their own -j/--jobs option.
+parser.set_defaults(jobs=1)
+
 parser.add_argument("--version", action="version", version="dep %%VERSION%%",
                     help="Show version and exit")
 parser.add_argument("-D", "--debug", action="store_true",
@@ -28,3 +64,7 @@ parser.add_argument("-v", "--verbose", action="store_true",
                     help="Show more verbose information, including commands executed")
 parser.add_argument("--dry-run", action="store_true",
                     help="Only show what actions and commands would be executed, make no changes")
+parser.add_argument("--mirror-dir", default=os.environ.get("DEP_MIRROR_DIR"),
+                    help="Directory of bare mirror repositories shared by clones, kept up to date on each clone (default $DEP_MIRROR_DIR)")
+parser.add_argument("--trace", metavar="FILE",
+                    help="Write every command executed to FILE in Chrome trace format, then show the slowest commands")
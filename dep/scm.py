@@ -6,9 +6,28 @@
 #
 import os
 import re
-from dep import opts
+import time
+import hashlib
+import threading
+import subprocess
+from dep import opts, trace
 from dep.helpers import *
 
+_symbolic_ref_re = re.compile(r"^ref:\s*(refs/\S+)$")
+_oid_re = re.compile(r"^([0-9a-f]{40}|[0-9a-f]{64})$")
+_ref_storage_re = re.compile(r"^\s*\[\s*extensions\s*\][^[]*?^\s*refstorage\s*=\s*(\S+)", re.M | re.I)
+
+# Repositories with edited files not yet staged, see GitRepository.post_edit().
+_unstaged_repositories = []
+_staging_lock = threading.Lock()
+
+def flush_staging():
+    # Stage every edited file, with one "git add" for each repository.
+    with _staging_lock:
+        repositories = list(_unstaged_repositories)
+    for repository in repositories:
+        repository.flush_staging()
+
 class Repository:
     def __init__(self, work_dir, url, vcs, name):
         self.work_dir = work_dir
@@ -17,6 +36,9 @@ class Repository:
         self.name = name
         self.branch = None
         self.commit = None
+        # Clone options, only used when downloading or fetching.
+        self.depth = None
+        self.filter = None
 
     def write_state_to_config_section(self, section):
         section["url"] = self.url
@@ -32,6 +54,26 @@ class Repository:
 
     def read_state_from_disk(self):
         pass
+
+    # Operations which may run alongside others, each returns a Job with the result
+    # of the blocking form, see spawn().
+    def refresh_async(self):
+        return spawn(self.refresh)
+
+    def fetch_async(self, args, host_limit=None):
+        return spawn(self.fetch, args, host_limit)
+
+    def status_async(self, path, kw):
+        return spawn(self.status, path, kw)
+
+    def is_ahead_async(self):
+        return spawn(self.is_ahead)
+
+    def fast_forward_async(self):
+        return spawn(self.fast_forward)
+
+    def create_refs_async(self, refs):
+        return spawn(self.create_refs, refs)
         
     @staticmethod
     def determine_vcs_from_url(url):
@@ -53,6 +95,17 @@ class Repository:
         name = re.sub(r"\.git$", "", name)        
         return name
     
+    @staticmethod
+    def determine_host_from_url(url):
+        # Either scheme://[user@]host[:port]/path or scp-like [user@]host:path, otherwise local.
+        m = re.match(r"^[a-zA-Z][-+.a-zA-Z0-9]*://(?:[^@/]*@)?([^/:]*)", url)
+        if m:
+            return m.group(1) or "localhost"
+        m = re.match(r"^(?:[^@/]*@)?([^/:]+):", url)
+        if m:
+            return m.group(1)
+        return "localhost"
+
     @staticmethod
     def create(work_dir, url=None, name=None, parent=None):
         # Determine URL and vcs if none provided
@@ -112,6 +165,12 @@ class FileRepository(Repository):
     def post_edit(self, path):
         pass
 
+    def flush_staging(self):
+        pass
+
+    def stage_all(self):
+        pass
+
     def download(self):
         pass
 
@@ -127,24 +186,48 @@ class FileRepository(Repository):
     def remove_ignore(self, path):
         pass
 
+    def flush_ignore(self):
+        pass
+
     def has_local_modifications(self):
         return True
+
+    def is_ahead(self):
+        return False
+
+    def fast_forward(self):
+        return True
    
     def refresh(self):
         pass
 
-    def record(self):
+    def record(self, snapshot=None):
         pass
 
     def merge_branch(self, name):
         pass
 
+    def fetch(self, args, host_limit=None):
+        return (0.0, 0)
+
+    def get_remote_url(self):
+        return self.url
+
     def status(self, path, kw):
         return True
 
+    def read_blob(self, rev, path):
+        error("Cannot read '{}' at {} from {}", path, rev, self)
+
+    def close_blobs(self):
+        pass
+
     def create_branch(self, name, startpoint):
         pass
 
+    def create_refs(self, refs):
+        return True
+
     def create_worktree(self, branch_name):
         pass
 
@@ -159,7 +242,16 @@ class GitRepository(Repository):
         self.git_common_dir = self._compute_git_common_dir()
         self.worktree_path = self._compute_worktree_path()
         self.ignore_file = os.path.join(work_dir, ".gitignore")
+        self._packed_refs = {}
+        self._packed_refs_signature = None
+        self._files_refs = None
         self.quiet_flag = "--quiet" if opts.args.quiet else None
+        self.blob_reader = None
+        self._unstaged_paths = []
+        # Ignore file contents read once, with added paths kept until flush_ignore().
+        self._ignores = None
+        self._ignores_signature = None
+        self._pending_ignores = []
 
     def __str__(self):
         return "{} '{}'".format(self.__class__.__name__, self.git_dir)
@@ -245,16 +337,42 @@ class GitRepository(Repository):
         return os.path.exists(dot_git_path)
         
     def register(self, path):
-        run("git", "add", path, cwd=self.work_dir)
+        self._stage(path)
 
     def unregister(self, path):
+        self.flush_staging()
         run("git", "rm", "--cached", path, cwd=self.work_dir)
 
     def pre_edit(self, path):
         pass
 
     def post_edit(self, path):
-        run("git", "add", path, cwd=self.work_dir)
+        self._stage(path)
+
+    def _stage(self, path):
+        # Staged later by flush_staging(), together with the other files edited.
+        with _staging_lock:
+            if not self._unstaged_paths:
+                _unstaged_repositories.append(self)
+            if path not in self._unstaged_paths:
+                self._unstaged_paths.append(path)
+
+    def flush_staging(self):
+        with _staging_lock:
+            paths = self._unstaged_paths
+            if not paths:
+                return
+            self._unstaged_paths = []
+            _unstaged_repositories.remove(self)
+        run("git", "add", *paths, cwd=self.work_dir)
+
+    def stage_all(self):
+        # Stages every change in the working directory, which includes any edited files.
+        with _staging_lock:
+            if self._unstaged_paths:
+                self._unstaged_paths = []
+                _unstaged_repositories.remove(self)
+        run("git", "add", "--all", ".", cwd=self.work_dir)
 
     def _worktree_add(self):
         self.parent.debug_dump("parent: ")
@@ -278,13 +396,76 @@ class GitRepository(Repository):
         self.git_dir = self._compute_git_dir()
         self.debug_dump("worktree: ")
         
+    def _get_mirror_path(self):
+        if not opts.args.mirror_dir:
+            return None
+        # Keyed by URL, the name only makes the mirror directory easier to recognise.
+        url_hash = hashlib.sha1(self.url).hexdigest()[:16]
+        mirror_name = "{}-{}.git".format(self.name, url_hash)
+        return os.path.join(os.path.abspath(opts.args.mirror_dir), mirror_name)
+
+    def _update_mirror(self):
+        mirror_path = self._get_mirror_path()
+        if mirror_path is None:
+            return None
+        # A mirror holds the whole history, a shallow or partial clone is smaller without it.
+        if self.depth is not None or self.filter is not None:
+            return None
+        # A mirror is only an optimisation, so failing to update it is not fatal.
+        if os.path.isdir(mirror_path):
+            status("Updating mirror '{}'\n    from '{}'", mirror_path, self.url)
+            run("git", "--git-dir", mirror_path, "fetch", self.quiet_flag, "--prune", "origin", allow_failure=True)
+        else:
+            status("Creating mirror '{}'\n    from '{}'", mirror_path, self.url)
+            make_dirs(os.path.dirname(mirror_path))
+            run("git", "clone", self.quiet_flag, "--mirror", self.url, mirror_path, allow_failure=True)
+        if not os.path.isdir(mirror_path):
+            return None
+        return mirror_path
+
     def _clone(self):
+        mirror_path = self._update_mirror()
         status("Downloading {}\n    from '{}'", self, self.url)
         if self._is_separate_git_dir():
             make_dirs(os.path.dirname(self.git_dir))
+        # Objects are copied from the mirror (--dissociate), so clones never depend on it.
+        reference_flag = None if mirror_path is None else "--reference"
+        dissociate_flag = None if mirror_path is None else "--dissociate"
+        clone_args = self._get_clone_options() + ["--no-checkout", self.url, self.work_dir]
         run("git", "clone",
             self.quiet_flag, self._get_separate_git_dir_flag(), self._get_separate_git_dir_arg(),
-            "--no-checkout", self.url, self.work_dir)
+            reference_flag, mirror_path, dissociate_flag, *clone_args)
+
+    def _get_clone_options(self):
+        # A shallow clone still has every branch, so the recorded branch can be checked out.
+        options = []
+        if self.depth is not None:
+            options += ["--depth", str(self.depth), "--no-single-branch"]
+        if self.filter is not None:
+            options += ["--filter", self.filter]
+        return options
+
+    def _is_shallow(self):
+        return os.path.exists(os.path.join(self.git_common_dir, "shallow"))
+
+    def _get_deepened_path(self):
+        # Exists once a shallow clone has been deepened past its configured depth.
+        return os.path.join(self.git_common_dir, "dep-deepened")
+
+    def _has_commit(self, commit):
+        return run_query("git", "rev-parse", "--verify", "--quiet", "{}^{{commit}}".format(commit),
+                         cwd=self.work_dir, allow_failure=True) is not None
+
+    def _deepen(self, commit):
+        # The recorded commit may be older than a shallow clone reaches, so deepen it
+        # in growing steps until it is found or the whole history has been fetched.
+        step = self.depth or 1
+        while self._is_shallow() and not self._has_commit(commit):
+            step *= 2
+            status("Deepening {} by {} commits\n    to reach commit '{}'", self, step, commit)
+            run("git", "fetch", self.quiet_flag, "--deepen", str(step), cwd=self.work_dir)
+            with open(self._get_deepened_path(), 'w'):
+                pass
         
     def download(self):
         validate_dir_notexists_or_empty(self.work_dir)
@@ -317,6 +498,8 @@ class GitRepository(Repository):
     def checkout(self, branch=None, commit=None):
         if not self._need_checkout(branch=branch, commit=commit):
             return
+        if commit is not None and not opts.args.dry_run:
+            self._deepen(commit)
         branch_flag = None if branch is None or commit is None else "-B"
         branch_name = None if branch is None else self._branch_name_from_ref(branch)
         commit_flag = None if commit is None else commit
@@ -325,6 +508,13 @@ class GitRepository(Repository):
         status("Checkout {}{}{}\n    in '{}'", self, branch_mesg, commit_mesg, self.work_dir)
         run("git", "checkout", self.quiet_flag, branch_flag, branch_name, commit_flag, cwd=self.work_dir)
 
+    def _get_ignore_signature(self):
+        try:
+            st = os.stat(self.ignore_file)
+        except OSError:
+            return None
+        return (st.st_mtime, st.st_size, st.st_ino)
+
     def _read_ignore(self):
         if not os.path.exists(self.ignore_file):
             return []
@@ -338,26 +528,44 @@ class GitRepository(Repository):
         except IOError, e:
             error("Cannot open '{}' for reading: {}", self.ignore_file, e)
 
+    def _get_ignores(self):
+        # Read again only if the file was changed by something else, such as a checkout.
+        signature = self._get_ignore_signature()
+        if self._ignores is None or (signature != self._ignores_signature and not self._pending_ignores):
+            self._ignores = set(self._read_ignore())
+            self._ignores_signature = signature
+        return self._ignores
+
     def has_ignore(self, path):
-        path = "/" + path
-        ignores = self._read_ignore()
-        return path in ignores
+        return "/" + path in self._get_ignores()
 
     def add_ignore(self, path):
         verbose("Adding '{}' to ignore file '{}'", path, self.ignore_file)
+        self._get_ignores().add("/" + path)
+        self._pending_ignores.append(path)
+
+    def flush_ignore(self):
+        # Append every path added since the last flush, then stage the file once.
+        pending = self._pending_ignores
+        if not pending:
+            return
+        self._pending_ignores = []
         if opts.args.dry_run:
             return
         # TODO: With git we know we can just post_edit the file to do the right thing.
         # TODO: With out vcs we might need register/pre_edit.
         try:
             with open(self.ignore_file, 'a') as f:
-                f.write('/{}\n'.format(path))
+                for path in pending:
+                    f.write('/{}\n'.format(path))
         except IOError, e:
             error("Cannot open '{}' for writing: {}'", self.ignore_file, e)
-        self.post_edit(self.ignore_file)            
+        self._ignores_signature = self._get_ignore_signature()
+        self.post_edit(self.ignore_file)
 
     def remove_ignore(self, path):
         verbose("Removing '{}' from ignore file '{}'", path, self.ignore_file)
+        self.flush_ignore()
         if opts.args.dry_run:
             return
         if not os.path.exists(self.ignore_file):
@@ -373,34 +581,17 @@ class GitRepository(Repository):
                         f.write('{}\n'.format(ignore))
         except IOError, e:
             error("Cannot open '{}' for writing: {}'", self.ignore_file, e)
+        self._ignores = None
         self.post_edit(self.ignore_file)
         # TODO: Remove if ignore file is now empty?
 
-    def _is_status_conflict(self, line):
-        style = line[0:2]
-        if style == "DD" or style == "AU" or style == "UD" or style == "UA":
-            return True
-        if style == "DU" or style == "AA" or style == "UU":
-            return True
-        return False
+    def _collect_status(self):
+        with Pipe("git", "status", "--porcelain=v2", "--branch", "-z", cwd=self.work_dir) as p:
+            return GitStatus.parse(p)
 
     def _get_status(self):
-        ahead = 0
-        behind = 0
-        changes = 0
-        conflicts = 0
-        with Pipe("git", "status", "--porcelain", "--branch", cwd=self.work_dir) as p:
-            for line in p:
-                m = re.match(r"##\s+[^[]*(\[(\s*ahead\s+(\d+)\s*)?,?(\s*behind\s+(\d+)\s*)?\])?", line)
-                if m:
-                    ahead = m.group(3) if m.group(3) else 0
-                    behind = m.group(5) if m.group(5) else 0
-                else:
-                    if self._is_status_conflict(line):
-                        conflicts = conflicts + 1
-                    else:
-                        changes = changes + 1
-        return (changes, ahead, behind, conflicts)
+        s = self._collect_status()
+        return (s.changes, s.ahead, s.behind, s.conflicts)
 
     def _is_merge_in_progress(self):
         # Local modifications if merge is in progress so merge will be committed.
@@ -411,8 +602,27 @@ class GitRepository(Repository):
         return self._is_merge_in_progress() or self._get_status()[0] > 0
 
     def is_ahead(self):
-        return self._get_status()[1] > 0
+        # Only counts commits, so unlike a status it never needs to scan the working directory.
+        # With no upstream branch it is never ahead, as status would report.
+        count = run_query("git", "rev-list", "--count", "@{upstream}..HEAD", cwd=self.work_dir, allow_failure=True)
+        return count is not None and int(count) > 0
     
+    def fast_forward(self):
+        # Merges the fetched upstream branch only if no merge commit is needed, returns
+        # False if both have new commits. With no upstream branch there is nothing to do.
+        counts = run_query("git", "rev-list", "--left-right", "--count", "HEAD...@{upstream}",
+                           cwd=self.work_dir, allow_failure=True)
+        if counts is None:
+            return True
+        (ahead, behind) = [int(count) for count in counts.split()]
+        if behind == 0:
+            return True
+        if ahead > 0:
+            return False
+        status("Fast-forward {}\n    by {} commits", self, behind)
+        run("git", "merge", self.quiet_flag, "--ff-only", "@{upstream}", cwd=self.work_dir)
+        return True
+
     def refresh(self):
         check_local = True
         if not os.path.exists(self.work_dir):
@@ -423,8 +633,114 @@ class GitRepository(Repository):
             error("{} has local modifications, not refreshed", self)
         self.checkout(self.branch, self.commit)
 
+    def _read_git_file(self, path):
+        try:
+            with open(path, 'r') as f:
+                return f.read()
+        except IOError:
+            return None
+
+    def _get_refs_dir(self):
+        # Worktrees keep HEAD in git_dir, but share refs in the common directory.
+        common_dir = self._read_git_file(os.path.join(self.git_dir, "commondir"))
+        if common_dir is None:
+            return self.git_common_dir
+        common_dir = common_dir.strip()
+        if not os.path.isabs(common_dir):
+            common_dir = os.path.normpath(os.path.join(self.git_dir, common_dir))
+        return common_dir
+
+    def _read_packed_refs(self, refs_dir):
+        packed_refs_path = os.path.join(refs_dir, "packed-refs")
+        try:
+            st = os.stat(packed_refs_path)
+        except OSError:
+            return {}
+        signature = (packed_refs_path, st.st_mtime, st.st_size)
+        if self._packed_refs_signature == signature:
+            return self._packed_refs
+        packed_refs = {}
+        contents = self._read_git_file(packed_refs_path) or ""
+        for line in contents.splitlines():
+            if not line or line[0] in "#^":
+                continue
+            (oid, _, ref) = line.partition(" ")
+            packed_refs[ref] = oid
+        self._packed_refs = packed_refs
+        self._packed_refs_signature = signature
+        return packed_refs
+
+    def _has_files_refs(self):
+        # Refs can only be read directly when kept as files, not in another ref storage
+        # such as reftable.
+        if self._files_refs is None:
+            contents = self._read_git_file(os.path.join(self._get_refs_dir(), "config")) or ""
+            m = _ref_storage_re.search(contents)
+            self._files_refs = m is None or m.group(1).lower() == "files"
+        return self._files_refs
+
+    def _read_symbolic_head(self):
+        # Returns the contents of HEAD: either a symbolic ref or a detached commit.
+        # None if it cannot be read directly, and git must be asked instead.
+        if not self._has_files_refs():
+            return None
+        head = self._read_git_file(os.path.join(self.git_dir, "HEAD"))
+        if head is None:
+            return None
+        head = head.strip()
+        m = _symbolic_ref_re.match(head)
+        if m:
+            # Other ref storage leaves HEAD pointing at an invalid branch.
+            if m.group(1) == "refs/heads/.invalid":
+                return None
+            return m.group(1)
+        if _oid_re.match(head):
+            return head
+        return None
+
+    def _resolve_ref(self, ref, paths=None):
+        # Any files read are added to 'paths'.
+        refs_dir = self._get_refs_dir()
+        for _ in range(5):
+            ref_path = os.path.join(refs_dir, ref)
+            if paths is not None:
+                paths.append(ref_path)
+            value = self._read_git_file(ref_path)
+            if value is None:
+                return self._read_packed_refs(refs_dir).get(ref)
+            value = value.strip()
+            m = _symbolic_ref_re.match(value)
+            if not m:
+                return value if _oid_re.match(value) else None
+            ref = m.group(1)
+        return None
+
+    def _get_state_paths(self, branch):
+        # Files holding the branch and commit, used to tell if they may have changed.
+        refs_dir = self._get_refs_dir()
+        paths = [os.path.join(self.git_dir, "HEAD"),
+                 os.path.join(self.git_dir, "commondir"),
+                 os.path.join(refs_dir, "packed-refs"),
+                 os.path.join(refs_dir, "reftable", "tables.list")]
+        self._resolve_ref(branch, paths)
+        return paths
+
+    def _read_branch(self):
+        head = self._read_symbolic_head()
+        if head is None:
+            return None
+        return "HEAD" if _oid_re.match(head) else head
+
+    def _read_commit(self):
+        head = self._read_symbolic_head()
+        if head is None or _oid_re.match(head):
+            return head
+        return self._resolve_ref(head)
+
     def _get_branch(self):
-        branch = run_query("git", "rev-parse", "--symbolic-full-name", "HEAD", cwd=self.work_dir).rstrip("\n")
+        branch = self._read_branch()
+        if branch is None:
+            branch = run_query("git", "rev-parse", "--symbolic-full-name", "HEAD", cwd=self.work_dir).rstrip("\n")
         # TODO: Check it is valid!
         if branch == "HEAD":
             # Detached head is not supported (yet), need to checkout a branch.
@@ -433,19 +749,24 @@ class GitRepository(Repository):
         return branch
 
     def _get_commit(self):
-        commit = run_query("git", "rev-parse", "HEAD", cwd=self.work_dir).rstrip("\n")
+        commit = self._read_commit()
+        if commit is None:
+            commit = run_query("git", "rev-parse", "HEAD", cwd=self.work_dir).rstrip("\n")
         # TODO: Check it is valid!
         return commit
 
     def _get_describe(self):
-        actual_branch = self._get_branch()
         describe = run_query("git", "describe", "--tags", "--always", cwd=self.work_dir).rstrip("\n")
         # TODO: Check it is valid!
         return describe
 
-    def record(self):
-        new_branch = self._get_branch()
-        new_commit = self._get_commit()
+    def record(self, snapshot=None):
+        state = None if snapshot is None else snapshot.lookup(self.work_dir)
+        if state is None:
+            state = (self._get_branch(), self._get_commit())
+            if snapshot is not None:
+                snapshot.update(self.work_dir, state[0], state[1], self._get_state_paths(state[0]))
+        (new_branch, new_commit) = state
         if new_branch != self.branch or new_commit != self.commit:
             self.branch = new_branch
             self.commit = new_commit
@@ -456,9 +777,63 @@ class GitRepository(Repository):
     def _branch_name_from_ref(self, ref):
         return re.sub(r"refs/heads/", "", ref)
 
+    def get_remote_url(self):
+        # Read remote.origin.url from the repository config, the root's url is only its own path.
+        contents = self._read_git_file(os.path.join(self._get_refs_dir(), "config")) or ""
+        m = re.search(r'^\s*\[\s*remote\s+"origin"\s*\][^[]*?^\s*url\s*=\s*(\S+)', contents, re.M)
+        return m.group(1) if m else self.url
+
+    def _get_objects_size(self):
+        size = 0
+        for dir_path, dir_names, file_names in os.walk(os.path.join(self._get_refs_dir(), "objects")):
+            for file_name in file_names:
+                try:
+                    size += os.path.getsize(os.path.join(dir_path, file_name))
+                except OSError:
+                    pass
+        return size
+
+    def fetch(self, args, host_limit=None):
+        # Returns the time taken and the growth in size of the object store.
+        url = self.get_remote_url()
+        status("Fetch {}\n    from '{}'", self, url)
+        size = self._get_objects_size()
+        host_limit = host_limit or KeyedLimit()
+        with host_limit.hold(Repository.determine_host_from_url(url)):
+            start = time.time()
+            run("git", "fetch", self.quiet_flag, *self._get_fetch_options(args), cwd=self.work_dir)
+            seconds = time.time() - start
+        return (seconds, max(0, self._get_objects_size() - size))
+
+    def _get_fetch_options(self, args):
+        # Keep a shallow dependency shallow, unless the depth is given explicitly. Once
+        # deepened or unshallowed, fetching at the configured depth would cut off the
+        # history it needs, so it is fetched without a depth.
+        if self.depth is None or any(re.match(r"^--(depth|deepen|shallow-\w+|unshallow)", a) for a in args):
+            return list(args)
+        if not self._is_shallow() or os.path.exists(self._get_deepened_path()):
+            return list(args)
+        return ["--depth", str(self.depth)] + list(args)
+
     def merge_branch(self, name):
         run("git", "merge", self.quiet_flag, "--no-commit", "--no-ff", name, cwd=self.work_dir, allow_failure=True)
 
+    def read_blob(self, rev, path):
+        # Contents of 'path' at commit 'rev', or None if it has no such file.
+        if not os.path.exists(self.git_dir):
+            error("Cannot read '{}' at {} from {}, it has not been downloaded", path, rev, self)
+        if self.blob_reader is None:
+            self.blob_reader = GitBlobReader(self.work_dir)
+        data = self.blob_reader.read("{}:{}".format(rev, path))
+        if data is None and self.blob_reader.read("{}^{{commit}}".format(rev)) is None:
+            error("Cannot find commit {} in {}, it may need to be fetched", rev, self)
+        return data
+
+    def close_blobs(self):
+        if self.blob_reader is not None:
+            self.blob_reader.close()
+            self.blob_reader = None
+
     def status(self, path, kw):
         if kw.get('status_long'):
             return self.status_long(path, kw)
@@ -468,9 +843,14 @@ class GitRepository(Repository):
     def status_short(self, path, kw):
         branch = self.branch
         commit = self.commit
-        actual_branch = self._get_branch()
-        actual_commit = self._get_commit()
-        changes, ahead, behind, conflicts = self._get_status()
+        s = self._collect_status()
+        if s.branch is None:
+            error("{} is checked out with a detached head, not yet supported; checkout a branch (not a tag)", self)
+        if s.commit is None:
+            error("{} has no commits yet on branch '{}', commit first", self, self._branch_name_from_ref(s.branch))
+        actual_branch = s.branch
+        actual_commit = s.commit
+        changes, ahead, behind, conflicts = (s.changes, s.ahead, s.behind, s.conflicts)
         merging = self._is_merge_in_progress()
         # Determine modification state
         if changes is None:
@@ -540,6 +920,14 @@ class GitRepository(Repository):
         status("Branch {}\n    to branch '{}'{}", self, name, starting)
         run("git", "checkout", "-b", name, startpoint, cwd=self.work_dir)
         
+    def create_refs(self, refs):
+        # Creates each (ref, start point) in one transaction, without touching the working
+        # directory. Either all or none are created, returns False if none were.
+        status("Create {}\n    in {}", ", ".join(ref for ref, startpoint in refs), self)
+        commands = "".join("create {} {}^{{commit}}\n".format(ref, startpoint) for ref, startpoint in refs)
+        exit_status = run("git", "update-ref", "--stdin", cwd=self.work_dir, input=commands, allow_failure=True)
+        return exit_status in [0, None]
+
     def create_worktree(self, branch_name):
         worktree_root = "branch"
         worktree_path = os.path.join(worktree_root, branch_name)
@@ -549,8 +937,96 @@ class GitRepository(Repository):
         # Ensure worktree_root is ignored.
         if not self.has_ignore(worktree_root):
             self.add_ignore(worktree_root)
+            self.flush_ignore()
         # Create a .deproot so root finding does not go through "branch" to parent directories.
         deproot_path = os.path.join(self.work_dir, worktree_root, ".deproot")
         if not os.path.exists(deproot_path):
             open(deproot_path, 'a').close()
         return Repository.create(work_dir)
+
+class GitBlobReader:
+    # Reads objects through one long running "git cat-file --batch", so reading many
+    # files at many commits of a repository costs a single process.
+    def __init__(self, work_dir):
+        cmd = ["git", "cat-file", "--batch"]
+        self.cmd_text = " ".join(cmd)
+        self.span = trace.begin(cmd, work_dir)
+        self.span.size = 0
+        self.lock = threading.Lock()
+        try:
+            self.process = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, cwd=work_dir)
+        except OSError, e:
+            error("Cannot execute '{}': {}'", self.cmd_text, e)
+
+    def read(self, name):
+        # Contents of the object 'name', as any revision expression, or None if missing.
+        with self.lock:
+            self.process.stdin.write("{}\n".format(name))
+            self.process.stdin.flush()
+            header = self.process.stdout.readline()
+            if not header:
+                error("{} exited while reading '{}'", self.cmd_text, name)
+            fields = header.split()
+            if len(fields) != 3:
+                return None
+            size = int(fields[2])
+            data = self.process.stdout.read(size + 1)[:size]
+            self.span.size += len(header) + size + 1
+            return data
+
+    def close(self):
+        self.process.stdin.close()
+        self.span.exit_status = self.process.wait()
+        self.span.finish()
+
+class GitStatus:
+    # Status of a git working directory, parsed from "git status --porcelain=v2 --branch -z".
+    def __init__(self):
+        self.branch = None
+        self.commit = None
+        self.ahead = 0
+        self.behind = 0
+        self.changes = 0
+        self.conflicts = 0
+
+    @staticmethod
+    def _read_records(handle):
+        pending = ""
+        while True:
+            chunk = handle.read(65536)
+            if not chunk:
+                break
+            records = (pending + chunk).split("\0")
+            pending = records.pop()
+            for record in records:
+                yield record
+        if pending:
+            yield pending
+
+    @staticmethod
+    def parse(handle):
+        status = GitStatus()
+        records = GitStatus._read_records(handle)
+        for record in records:
+            if record.startswith("# "):
+                status._parse_header(record[2:])
+            elif record.startswith("u "):
+                status.conflicts += 1
+            elif record.startswith("2 "):
+                # Renamed or copied entries are followed by the original path.
+                next(records, None)
+                status.changes += 1
+            elif record.startswith("1 ") or record.startswith("? "):
+                status.changes += 1
+        return status
+
+    def _parse_header(self, header):
+        (key, _, value) = header.partition(" ")
+        if key == "branch.oid":
+            self.commit = None if value == "(initial)" else value
+        elif key == "branch.head":
+            self.branch = None if value == "(detached)" else "refs/heads/{}".format(value)
+        elif key == "branch.ab":
+            (ahead, behind) = value.split(" ")
+            self.ahead = int(ahead.lstrip("+"))
+            self.behind = int(behind.lstrip("-"))
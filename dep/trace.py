@@ -0,0 +1,157 @@
+#
+# Command Trace
+# =============
+#
+# %%LICENSE%%
+#
+import os
+import sys
+import time
+import atexit
+import threading
+
+# Active Tracer when --trace was given, see enable().
+_tracer = None
+
+# Absolute path of each dependency to its name, used to find which node a
+# command ran for from its working directory.
+_node_paths = {}
+
+SUMMARY_COUNT = 10
+
+def enable(path, name, argv):
+    global _tracer
+    _tracer = Tracer(path, name, argv)
+    atexit.register(_tracer.finish)
+
+def register_node(abs_path, name):
+    _node_paths[abs_path] = name
+
+def find_node(cwd):
+    path = cwd
+    while True:
+        name = _node_paths.get(path)
+        if name is not None:
+            return name
+        parent = os.path.dirname(path)
+        if parent == path:
+            return None
+        path = parent
+
+def begin(cmd, cwd=None):
+    if _tracer is None:
+        return _NoSpan()
+    return Span(_tracer, cmd, cwd)
+
+class Span:
+    # One command execution, the caller sets exit_status and size before finish().
+    def __init__(self, tracer, cmd, cwd):
+        self.tracer = tracer
+        self.cmd = list(cmd)
+        self.cwd = os.path.abspath(cwd) if cwd else os.getcwd()
+        self.exit_status = None
+        self.size = None
+        self.thread = threading.current_thread()
+        self.start = time.time()
+        self.duration = None
+
+    def finish(self):
+        if self.duration is not None:
+            return
+        self.duration = time.time() - self.start
+        self.tracer.add(self)
+
+    @property
+    def name(self):
+        return " ".join(self.cmd[:2])
+
+    @property
+    def node(self):
+        return find_node(self.cwd)
+
+class _NoSpan:
+    exit_status = None
+    size = None
+
+    def finish(self):
+        pass
+
+class Tracer:
+    # Collects every command run, then at exit writes them to 'path' in Chrome trace
+    # event format, as loaded by chrome://tracing or Perfetto, and shows the slowest.
+    def __init__(self, path, name, argv):
+        self.path = os.path.abspath(path)
+        self.name = name
+        self.argv = list(argv)
+        self.thread = threading.current_thread()
+        self.start = time.time()
+        self.spans = []
+        self.lock = threading.Lock()
+        self.thread_ids = {}
+
+    def add(self, span):
+        with self.lock:
+            self.spans.append(span)
+
+    def _thread_id(self, thread):
+        if thread not in self.thread_ids:
+            self.thread_ids[thread] = len(self.thread_ids) + 1
+        return self.thread_ids[thread]
+
+    def _microseconds(self, seconds):
+        return int(round(seconds * 1000000))
+
+    def _event(self, name, category, start, duration, thread, args):
+        return {
+            'name': name,
+            'cat': category,
+            'ph': "X",
+            'ts': self._microseconds(start - self.start),
+            'dur': self._microseconds(duration),
+            'pid': os.getpid(),
+            'tid': self._thread_id(thread),
+            'args': args,
+        }
+
+    def events(self, duration):
+        with self.lock:
+            spans = list(self.spans)
+        events = [self._event(self.name, "dep", self.start, duration, self.thread,
+                              {'argv': self.argv, 'cwd': os.getcwd()})]
+        for span in spans:
+            events.append(self._event(span.name, "command", span.start, span.duration, span.thread, {
+                'argv': span.cmd,
+                'cwd': span.cwd,
+                'exit': span.exit_status,
+                'bytes': span.size,
+                'node': span.node,
+            }))
+        for thread, tid in self.thread_ids.items():
+            events.append({'name': "thread_name", 'ph': "M", 'pid': os.getpid(), 'tid': tid,
+                           'args': {'name': thread.name}})
+        return (spans, events)
+
+    def finish(self):
+        # Only needed with --trace, so not imported at startup.
+        import json
+        duration = time.time() - self.start
+        (spans, events) = self.events(duration)
+        try:
+            with open(self.path, 'w') as handle:
+                json.dump({'traceEvents': events, 'displayTimeUnit': "ms"}, handle)
+        except IOError, e:
+            sys.stderr.write("dep: Cannot write trace '{}': {}\n".format(self.path, e))
+        self.show_summary(spans, duration)
+
+    def show_summary(self, spans, duration):
+        total = sum(span.duration for span in spans)
+        sys.stderr.write("dep: {} commands took {:.2f}s in total, {:.2f}s elapsed, trace written to '{}'\n".format(
+            len(spans), total, duration, self.path))
+        slowest = sorted(spans, key=lambda span: span.duration, reverse=True)[:SUMMARY_COUNT]
+        if not slowest:
+            return
+        sys.stderr.write("    Time Exit Node                 Command\n")
+        for span in slowest:
+            exit_status = "-" if span.exit_status is None else span.exit_status
+            sys.stderr.write("{:7.3f}s {:>4} {:20} {}\n".format(span.duration, exit_status, span.node or "-",
+                                                                 " ".join(span.cmd)))